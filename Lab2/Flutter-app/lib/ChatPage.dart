@@ -127,7 +127,7 @@ class _ChatPage extends State<ChatPage> {
 
     if (text.length > 0) {
       try {
-        widget.connection!.output.add(Uint8List.fromList(utf8.encode(text)));
+        widget.connection!.output.add(Uint8List.fromList(utf8.encode(text + "\n")));
         await widget.connection!.output.allSent;
 
         widget.onSentMessage(clientID, text);
@@ -312,7 +312,7 @@ class _MainPage extends State<MainPage> {
     text = text.trim();
     if (text.length > 0) {
       try {
-        connection!.output.add(Uint8List.fromList(utf8.encode(text)));
+        connection!.output.add(Uint8List.fromList(utf8.encode(text + "\n")));
         await connection!.output.allSent;
       } catch (e) {
         setState(() {});
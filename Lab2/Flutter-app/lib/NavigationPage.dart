@@ -116,7 +116,7 @@ class _NavigationPage extends State<NavigationPage> {
     text = text.trim();
     if (text.isNotEmpty) {
       try {
-        widget.connection!.output.add(Uint8List.fromList(utf8.encode(text)));
+        widget.connection!.output.add(Uint8List.fromList(utf8.encode(text + "\n")));
         await widget.connection!.output.allSent;
       } catch (e) {
         print("Error while sending message in NavigationPage: ${e.toString()}");
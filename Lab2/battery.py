@@ -0,0 +1,76 @@
+import threading
+from collections import deque
+
+
+ADC_ADDR = 0x14
+BATTERY_CHANNEL = 0x13
+# ADC resolution = 12 bits (0–4095)
+#     https://ptelectronics.ru/wp-content/uploads/AT32F413RCT7.pdf page 20
+# ADC reference voltage: Usually 3.3V
+#     https://ptelectronics.ru/wp-content/uploads/AT32F413RCT7.pdf page 29
+# resistor divider is likely 3:1
+ADC_MAX, ADC_VREF, DIVIDER = 4095, 3.3, 3
+
+
+def voltage_to_percent(voltage):
+    if voltage >= 8.28:
+        return 100
+    elif voltage >= 8.0:
+        return 90
+    elif voltage >= 7.8:
+        return 75
+    elif voltage >= 7.5:
+        return 50
+    elif voltage >= 7.0:
+        return 25
+    elif voltage >= 6.6:
+        return 10
+    else:
+        return 0
+
+
+class BatteryMonitor:
+    # Owns one SMBus handle for the life of the process and reads the battery
+    # ADC channel with the Robot HAT's own sequence: select the channel with a
+    # word write, then read the two result bytes. The lock keeps the three
+    # transactions together. Voltage is averaged over the last `window`
+    # readings so the percentage does not flicker between steps under load.
+
+    def __init__(self, bus, window=10, addr=ADC_ADDR, channel=BATTERY_CHANNEL):
+        self.bus = bus
+        self.addr = addr
+        self.channel = channel
+        self._voltages = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.raw = None
+        self.voltage = None
+        self.filtered_voltage = None
+
+    def read_raw(self):
+        with self._lock:
+            self.bus.write_word_data(self.addr, self.channel, 0)
+            msb = self.bus.read_byte(self.addr)
+            lsb = self.bus.read_byte(self.addr)
+        return (msb << 8) | lsb
+
+    def read(self):
+        # take one sample, returns the filtered battery percentage
+        raw = self.read_raw()
+        voltage = raw * ADC_VREF / ADC_MAX * DIVIDER
+        self._voltages.append(voltage)
+        self.raw, self.voltage = raw, voltage
+        self.filtered_voltage = sum(self._voltages) / len(self._voltages)
+        return voltage_to_percent(self.filtered_voltage)
+
+    def status(self):
+        if self.voltage is None:
+            return {}
+        return {
+            'voltage': round(self.filtered_voltage, 2),
+            'voltage_now': round(self.voltage, 2),
+            'battery_now': voltage_to_percent(self.voltage),
+        }
+
+    def close(self):
+        with self._lock:
+            self.bus.close()
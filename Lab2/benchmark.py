@@ -0,0 +1,264 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+from time import perf_counter, sleep, time
+
+
+# Load generator for wifi_electron_server.py. Every simulated client keeps
+# one connection open and pipelines up to --inflight requests, drawn from the
+# service mix. Latency is measured per request from send to reply.
+#
+#   python3 benchmark.py --spawn-sim --clients 8 --duration 20 --output after.json --compare before.json
+
+HOST, PORT = '127.0.0.1', 65432
+DEFAULT_MIX = 'dir=1,power=1,battery=2,temp=2,speed=2,all=1'
+SERVICES = ('dir', 'power', 'battery', 'temp', 'speed', 'all')
+DIRECTIONS = ('f', 'b', 'l', 'r', 's')
+PERCENTILES = (50, 95, 99)
+REGRESSION_TOLERANCE = 0.2 # fraction a percentile may grow before --compare fails
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wifi_electron_server.py')
+
+
+def parse_mix(spec):
+    weights = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, weight = item.partition('=')
+        if name not in SERVICES:
+            raise ValueError(f"Unknown service in mix: {name}")
+        weights[name] = float(weight or 1)
+    if not weights:
+        raise ValueError("The mix needs at least one service")
+    return weights
+
+
+def make_request(family, rng):
+    if family == 'dir':
+        return f"dir.{rng.choice(DIRECTIONS)}"
+    if family == 'power':
+        return f"power.{rng.randrange(10, 61, 10)}"
+    return family
+
+
+def percentile(sorted_values, p):
+    # nearest rank
+    if not sorted_values:
+        return None
+    rank = max(1, -(-p * len(sorted_values) // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class Client:
+    # One dashboard/driver: a writer loop and a reader thread on one socket
+
+    def __init__(self, index, args, weights, deadline):
+        self.index = index
+        self.args = args
+        self.rng = random.Random(args.seed + index)
+        self.families, self.weights = list(weights), list(weights.values())
+        self.deadline = deadline
+        self.latencies = {family: [] for family in weights}
+        self.errors = {family: 0 for family in weights}
+        self.lost = 0
+        self._sent = {} # id -> (family, send time)
+        self._slots = threading.Semaphore(args.inflight)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def run(self):
+        sock = socket.create_connection((self.args.host, self.args.port), timeout=self.args.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = threading.Thread(target=self._read, args=(sock,), daemon=True)
+        reader.start()
+        period = 1.0 / self.args.rate if self.args.rate else 0
+        next_send = perf_counter()
+        try:
+            while perf_counter() < self.deadline:
+                if not self._slots.acquire(timeout=self.args.timeout):
+                    break
+                if period:
+                    next_send += period
+                    sleep(max(0, next_send - perf_counter()))
+                family = self.rng.choices(self.families, self.weights)[0]
+                request_id = next(self._ids)
+                line = json.dumps({'id': request_id, 'service': make_request(family, self.rng)}) + '\n'
+                with self._lock:
+                    self._sent[request_id] = (family, perf_counter())
+                sock.sendall(line.encode('utf-8'))
+            # give the last replies a moment to arrive
+            for _ in range(self.args.inflight):
+                self._slots.acquire(timeout=self.args.timeout)
+        except OSError as e:
+            print(f"Client {self.index} stopped: {str(e)}")
+        finally:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+            reader.join(timeout=2)
+        self.lost += len(self._sent)
+
+    def _read(self, sock):
+        buf = b''
+        while True:
+            try:
+                chunk = sock.recv(4096)
+            except OSError:
+                return
+            if not chunk:
+                return
+            received = perf_counter()
+            buf += chunk
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                if not line.strip():
+                    continue
+                reply = json.loads(line)
+                with self._lock:
+                    family, sent = self._sent.pop(reply.get('id'), (None, None))
+                if family is None:
+                    continue
+                if 'error' in reply:
+                    self.errors[family] += 1
+                else:
+                    self.latencies[family].append(received - sent)
+                self._slots.release()
+
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    summary = {
+        'count': len(values),
+        'errors': errors,
+        'throughput': round(len(values) / elapsed, 2),
+    }
+    if values:
+        summary['mean_ms'] = round(sum(values) / len(values) * 1000, 3)
+        summary['max_ms'] = round(values[-1] * 1000, 3)
+        for p in PERCENTILES:
+            summary[f"p{p}_ms"] = round(percentile(values, p) * 1000, 3)
+    return summary
+
+
+def run_benchmark(args, weights):
+    deadline = perf_counter() + args.duration
+    clients = [Client(i, args, weights, deadline) for i in range(args.clients)]
+    threads = [threading.Thread(target=c.run, name=f"client-{c.index}") for c in clients]
+    started = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - started
+
+    results = {}
+    everything, total_errors = [], 0
+    for family in weights:
+        latencies = [l for c in clients for l in c.latencies[family]]
+        errors = sum(c.errors[family] for c in clients)
+        results[family] = summarize(latencies, errors, elapsed)
+        everything += latencies
+        total_errors += errors
+    results['total'] = summarize(everything, total_errors, elapsed)
+    results['total']['lost'] = sum(c.lost for c in clients)
+    return results, elapsed
+
+
+def compare(results, baseline, tolerance):
+    # returns the list of regressions against a previous results file
+    regressions = []
+    for family, summary in results['services'].items():
+        before = baseline.get('services', {}).get(family)
+        if not before:
+            continue
+        for p in PERCENTILES:
+            key = f"p{p}_ms"
+            if key in summary and before.get(key) and summary[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{family} {key}: {before[key]} -> {summary[key]}")
+        if before.get('throughput') and summary['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f"{family} throughput: {before['throughput']} -> {summary['throughput']}")
+    return regressions
+
+
+def spawn_server(args):
+    env = dict(os.environ, PICAR_HARDWARE='sim')
+    command = [sys.executable, SERVER, '--host', args.host, '--port', str(args.port), *args.server_args]
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection((args.host, args.port), timeout=0.5).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise Exception(f"Server exited with code {server.returncode}")
+            sleep(0.1)
+    server.terminate()
+    raise Exception("Server did not start listening in time")
+
+
+def print_table(services):
+    print(f"{'service':<10}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for family, s in services.items():
+        print(f"{family:<10}{s['count']:>8}{s['errors']:>8}{s['throughput']:>10}"
+              f"{s.get('p50_ms', '-'):>10}{s.get('p95_ms', '-'):>10}{s.get('p99_ms', '-'):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the PiCar-X Wi-Fi server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--clients', type=int, default=4, help="concurrent connections")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of load")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="weighted services, e.g. dir=1,battery=2,all=1")
+    parser.add_argument('--inflight', type=int, default=1, help="pipelined requests per client")
+    parser.add_argument('--rate', type=float, default=0, help="requests per second per client, 0 = as fast as possible")
+    parser.add_argument('--timeout', type=float, default=5.0, help="seconds before a client gives up on a reply")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="previous results file; exit 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument('--spawn-sim', action='store_true',
+                        help="start wifi_electron_server.py with PICAR_HARDWARE=sim for the run")
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[],
+                        help="extra arguments for the spawned server, e.g. --engine asyncio")
+    args = parser.parse_args()
+    weights = parse_mix(args.mix)
+
+    server = spawn_server(args) if args.spawn_sim else None
+    try:
+        services, elapsed = run_benchmark(args, weights)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=5)
+
+    results = {
+        'timestamp': time(),
+        'host': platform.node(),
+        'config': {key: getattr(args, key) for key in ('clients', 'duration', 'mix', 'inflight', 'rate', 'seed', 'server_args')},
+        'elapsed': round(elapsed, 3),
+        'services': services,
+    }
+    print_table(services)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import struct
+
+
+# Compact framing used alongside newline-delimited JSON on the same port.
+# Every binary frame starts with a byte >= 0x80, which JSON text never does,
+# so the first byte a client sends tells the server which protocol it speaks.
+#
+# Requests (client -> car), fixed length per opcode:
+#   0x80..0x84              1 byte   steer forward/backward/left/right/stop
+#   0x85 <power:u8>         2 bytes  set power
+#   0x86 <mask:u8>          2 bytes  read the telemetry fields in mask
+#   0x87 <mask:u8> <hz:u8>  3 bytes  push the fields in mask up to hz times a second,
+#                                    mask 0 or hz 0 stops (Bluetooth only)
+#
+# Replies (car -> client):
+#   0xC0 <mask:u8> fields   telemetry frame, fields in FIELDS order, only those in mask
+#   0xC1 <code:u8>          error frame
+#   0xC2 <mask:u8> fields   pushed telemetry, laid out like 0xC0, holding only the
+#                           fields that changed; never the reply to a request
+
+OP_FORWARD, OP_BACKWARD, OP_LEFT, OP_RIGHT, OP_STOP = 0x80, 0x81, 0x82, 0x83, 0x84
+OP_POWER, OP_QUERY, OP_PUSH = 0x85, 0x86, 0x87
+PUSH = 'push' # service of a push request: 'push.<hz>'
+TELEMETRY, ERROR, PUSHED = 0xC0, 0xC1, 0xC2
+ERR_FAILED, ERR_BUSY, ERR_EXPIRED = 1, 2, 3
+
+DIR_CODES = {'stop': 0, 'forward': 1, 'backward': 2, 'left': 3, 'right': 4}
+STEER_OPS = {OP_FORWARD: 'dir.f', OP_BACKWARD: 'dir.b', OP_LEFT: 'dir.l', OP_RIGHT: 'dir.r', OP_STOP: 'dir.s'}
+OP_LENGTHS = dict.fromkeys(STEER_OPS, 1)
+OP_LENGTHS.update({OP_POWER: 2, OP_QUERY: 2, OP_PUSH: 3})
+
+# (reply key, mask bit, struct code, scale)
+FIELDS = (
+    ('battery', 0x01, 'B', 1),        # percent
+    ('temperature', 0x02, 'h', 10),   # 0.1 °C
+    ('speed', 0x04, 'h', 100),        # 0.01 cm/s
+    ('power', 0x08, 'B', 1),          # percent
+    ('distance', 0x10, 'I', 100),     # 0.01 cm
+    ('dir', 0x20, 'B', None),         # DIR_CODES
+)
+FIELD_BITS = {name: bit for name, bit, _, _ in FIELDS}
+CODE_RANGES = {'B': (0, 0xFF), 'h': (-0x8000, 0x7FFF), 'I': (0, 0xFFFFFFFF)} # values are clamped to these
+ALL_MASK = 0x3F
+MOTOR_MASK = FIELD_BITS['dir'] | FIELD_BITS['speed'] | FIELD_BITS['power'] | FIELD_BITS['distance']
+
+# one precompiled struct per mask, built on first use
+_layouts = {}
+
+
+def is_binary(first_byte):
+    return first_byte >= 0x80
+
+
+def mask_fields(mask):
+    return [name for name, bit, _, _ in FIELDS if mask & bit]
+
+
+def _layout(mask):
+    layout = _layouts.get(mask)
+    if layout is None:
+        codes = ''.join(code for _, bit, code, _ in FIELDS if mask & bit)
+        layout = _layouts[mask] = struct.Struct('<BB' + codes)
+    return layout
+
+
+class BinaryDecoder:
+    # Buffers a byte stream and yields (service, reply mask) per complete request.
+    # service is what handle_client_event expects: a 'dir.x'/'power.n' string
+    # or a list of field names. A push request is ('push.<hz>', field mask).
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def pending(self):
+        # True while a partial frame is buffered
+        return bool(self._buf)
+
+    def feed(self, data):
+        self._buf += data
+        requests = []
+        while self._buf:
+            op = self._buf[0]
+            length = OP_LENGTHS.get(op)
+            if length is None:
+                raise ValueError(f"Unknown binary opcode: {op:#x}")
+            if len(self._buf) < length:
+                break
+            if op in STEER_OPS:
+                requests.append((STEER_OPS[op], MOTOR_MASK))
+            elif op == OP_POWER:
+                requests.append((f"power.{self._buf[1]}", MOTOR_MASK))
+            elif op == OP_PUSH:
+                requests.append((f"{PUSH}.{self._buf[2]}", self._buf[1] & ALL_MASK))
+            else:
+                mask = self._buf[1] & ALL_MASK
+                requests.append((mask_fields(mask), mask))
+            del self._buf[:length]
+        return requests
+
+
+def encode_reply(res, mask, kind=TELEMETRY):
+    # kind: TELEMETRY for replies, PUSHED for unsolicited pushes
+    if 'error' in res:
+        code = {'busy': ERR_BUSY, 'expired': ERR_EXPIRED}.get(res['error'], ERR_FAILED)
+        return bytes((ERROR, code))
+    # only send what the reply actually holds (e.g. a timed-out field)
+    mask &= sum(bit for name, bit, _, _ in FIELDS if name in res)
+    values = []
+    for name, bit, code, scale in FIELDS:
+        if not mask & bit:
+            continue
+        value = res[name]
+        if scale is None:
+            values.append(DIR_CODES.get(value, 0))
+        else:
+            low, high = CODE_RANGES[code]
+            values.append(min(high, max(low, round(float(value) * scale))))
+    return _layout(mask).pack(kind, mask, *values)
+
+
+def pack_push(mask, hz):
+    # client-side helper: start (or with mask/hz 0, stop) telemetry push
+    return bytes((OP_PUSH, mask & ALL_MASK, min(hz, 255)))
+
+
+def decode_reply(frame):
+    # client-side helper: returns the reply dict for one frame; a push has 'push': True
+    if frame[0] == ERROR:
+        return {'error': {ERR_BUSY: 'busy', ERR_EXPIRED: 'expired'}.get(frame[1], 'failed')}
+    mask = frame[1]
+    layout = _layout(mask)
+    values = layout.unpack(frame[:layout.size])[2:]
+    names = {code: name for name, code in DIR_CODES.items()}
+    res = {}
+    for (name, _, _, scale), value in zip([f for f in FIELDS if mask & f[1]], values):
+        res[name] = names.get(value) if scale is None else value / scale
+    if frame[0] == PUSHED:
+        res['push'] = True
+    return res
+
+
+def reply_size(frame_head):
+    # bytes in the frame that starts with frame_head (at least 2 bytes)
+    if frame_head[0] == ERROR:
+        return 2
+    return _layout(frame_head[1]).size
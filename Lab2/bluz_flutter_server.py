@@ -1,203 +1,229 @@
 from bluedot.btcomm import BluetoothServer
 from signal import pause
 import json
-from smbus import SMBus
-import subprocess
-import re
-from time import sleep, time
-from picarx import Picarx
-from vilib import Vilib
+import os
+import queue
+import threading
+from time import sleep, perf_counter
+import binary_protocol
+import car
+from car import QUEUE_SIZE, DEADLINES, metrics
+from commands import UnknownCommand
+from framing import CommandFramer
+import log
 import random
+from scheduler import RequestScheduler, SUPERSEDED
+from telemetry import AdaptiveSubscription
 
 
-power = 10
-LEFT, RIGHT, FORWARD, BACKWARD, STOP = 'left', 'right', 'forward', 'backward', 'stop'
 KEY = 'service'
-camera_on = False
-curr_dir, curr_time, distance = STOP, time(), 0
-powerDistMap = { # cm/s
-    FORWARD: 0.3,
-    BACKWARD: 0.1,
-    LEFT: 0.15,
-    RIGHT: 0.13,
-}
-
-px = Picarx()
-
-
-def read_speed():
-    distance_1 = round(px.ultrasonic.read(), 2)
-    sleep(1)
-    distance_2 = round(px.ultrasonic.read(), 2)
-    diff_dist = distance_2-distance_1
-    print(f"speed in cm/s: {diff_dist}")
-    return round(diff_dist, 2)
-
-def read_temperature():
-    result = subprocess.run(['vcgencmd', 'measure_temp'], capture_output=True, text=True, check=True)
-    if result.stderr:
-        raise Exception(result.stderr)
-    print(f"Temperature stdout: {result.stdout}")
-    match = re.search(r'\d+\.\d+', result.stdout)
-    if not match:
-        raise Exception(f"Temp reading is malformed: {result.stdout}")
-    print(f"Temperature: {match.group()}")
-    return match.group()
-
-def voltage_to_percent(voltage):
-    if voltage >= 8.28:
-        return 100
-    elif voltage >= 8.0:
-        return 90
-    elif voltage >= 7.8:
-        return 75
-    elif voltage >= 7.5:
-        return 50
-    elif voltage >= 7.0:
-        return 25
-    elif voltage >= 6.6:
-        return 10
-    else:
-        return 0
-
-def read_battery_level():
-    bus = SMBus(1)
-    bus.write_word_data(0x14, 0x13, 0)
-    msb = bus.read_byte(0x14)
-    lsb = bus.read_byte(0x14)
-    raw_adc = (msb << 8) | lsb
-    
-    # convert to battery level
-    voltage = raw_adc * 3.3 / 4095 * 3  
-    # ADC resolution = 12 bits (0–4095)
-    #     https://ptelectronics.ru/wp-content/uploads/AT32F413RCT7.pdf page 20
-    # ADC reference voltage: Usually 3.3V
-    #     https://ptelectronics.ru/wp-content/uploads/AT32F413RCT7.pdf page 29
-    # resistor divider is likely 3:1
-    battery_percent = voltage_to_percent(voltage)
-    print(f"Raw ADC: {raw_adc}, Voltage: {voltage:.2f} V, Battery: {battery_percent}%")
-
-    return battery_percent
-
-def calculateDistance(curr_time):
-    end_time = time()
-    if curr_dir is None or curr_dir == STOP:
-        curr_time = end_time
-        return 0
-    dist = powerDistMap[curr_dir]*power*(end_time - curr_time)
-    curr_time = end_time
-    return dist
-
-def returnDistance(dist):
-    return round(dist, 2)
-
-def move(direction, power):
-    if direction == STOP:
-        px.stop()
-    else:
-        if direction == FORWARD:
-            px.set_dir_servo_angle(0)
-            px.set_motor_speed(1, power*0.6)
-            px.set_motor_speed(2, -power)
-        elif direction == BACKWARD:
-            px.set_dir_servo_angle(0)
-            px.set_motor_speed(1, -power)
-            px.set_motor_speed(2, power*1.6)
-        elif direction == LEFT:
-            px.set_dir_servo_angle(-30)
-            px.set_motor_speed(1, -power)
-            px.set_motor_speed(2, -power)
-        elif direction == RIGHT:
-            px.set_dir_servo_angle(30) 
-            px.set_motor_speed(1, power)
-            px.set_motor_speed(2, power)
+METRICS_PORT = os.environ.get('PICAR_METRICS_PORT') # serve Prometheus metrics over HTTP when set
+MESSAGES = ["Done!", "Anything else?", "Let's go!", "Ask more.", "All sent."]
+BT_WORKERS = 2 # threads running handle_client_event off bluedot's receive thread
+MAX_PUSH_RATE, MIN_PUSH_RATE = 20.0, 1.0 # pushes per second
+PUSH_IDLE = 0.2 # seconds between checks while nothing is subscribed
+PUSH_PREFIX = binary_protocol.PUSH + '.'
+
 
 def handle_client_event(service):
     res = {}
-    global power
-    global curr_dir
-    global camera_on
-    global distance
-    global curr_time
+    res['all'] = 0
     try:
-        print(f"service: {service}")
-        res['all'] = 0
-        if service.startswith("dir"):
-            if '.' in service:
-                distance += calculateDistance(curr_time)
-                direction = service.split('.')[1]
-                print(f"direction: {direction}")
-                if direction in ['l', LEFT]:
-                    move(LEFT, power)
-                    curr_dir = LEFT
-                elif direction in ['r', RIGHT]:
-                    move(RIGHT, power)
-                    curr_dir = RIGHT
-                elif direction in ['f', FORWARD]:
-                    move(FORWARD, power)
-                    curr_dir = FORWARD
-                elif direction in ['b', BACKWARD]:
-                    move(BACKWARD, power)
-                    curr_dir = BACKWARD
-                elif direction in ['s', STOP]:
-                    move(STOP, power)
-                    curr_dir = STOP
-            print(f"curr_dir: {curr_dir}")
-            res['dir'] = curr_dir
-            res['speed'] = read_speed()
-            res['power'] = power
-            res['distance'] = returnDistance(distance)
-        elif service in ["battery", "batt"]:
-            res['battery'] = read_battery_level()
-        elif service in ["temp", "temperature"]:
-            res['temperature'] = read_temperature()
-        elif service in ["speed"]:
-            res['speed'] = read_speed()
-            res['power'] = power
-        elif service.startswith("power"):
-            if '.' in service:
-                distance += calculateDistance(curr_time)
-                new_power = int(service.split('.')[1])
-                print(f"new_power: {new_power}")
-                power = new_power
-            res['speed'] = read_speed()
-            res['power'] = power
-            res['distance'] = returnDistance(distance)
-            move(curr_dir, power)
-            print(f"power updated: {power}")
-        elif service in ["dist", "distance"]:
-            res['distance'] = returnDistance(distance)
-        elif service == "all":
-            res['battery'] = read_battery_level()
-            res['temperature'] = read_temperature()
-            res['speed'] = read_speed()
-            res['power'] = power
-            res['distance'] = returnDistance(distance)
+        if car.handle(service, res) == 'all':
             res['all'] = 1
-        else:
-            res["message"] = "Try again"
-            return res
-        res["message"] = random.choice(["Done!", "Anything else?", "Let's go!", "Ask more.", "All sent."])
+        res["message"] = random.choice(MESSAGES)
+    except UnknownCommand as e:
+        res["message"] = "Try again"
+        res['error'] = str(e)
     except Exception as e:
-        print(f"Error occured while reading [{service}]: {str(e)}")
+        metrics.count_error(service)
+        log.error('service_failed', service=service, error=e)
         res["message"] = f"Error occured while reading [{service}]: {str(e)}"
+        res['error'] = str(e) # binary clients get an 0xC1 failed frame
     return res
 
+handle_client_event = metrics.track(handle_client_event) # per-service counts and latency
+
+# bluedot's receive callback only queues the command; workers run it and the
+# sender thread writes the replies, so a slow read never holds up the reader
+scheduler = RequestScheduler(handle_client_event, BT_WORKERS, QUEUE_SIZE, car.service_priority, DEADLINES, car.steering_key)
+metrics.add_gauge('bt_queue', scheduler.depth)
+metrics.add_gauge('bt_rejected', lambda: scheduler.rejected)
+metrics.add_gauge('bt_superseded', lambda: scheduler.superseded)
+outbox = queue.SimpleQueue() # (futures, encode), a batch once all of it is done
+sender = None
+push = None # AdaptiveSubscription of the connected phone, if it asked for one
+pusher = None
+push_stop = threading.Event()
+metrics.add_gauge('bt_push_rate', lambda: round(push.rate, 2) if push is not None else 0)
+
+def submit(services, encode):
+    # Queues the commands from one chunk; encode(replies) builds the single
+    # frame that answers all of them, sent when the last one finishes.
+    futures = [scheduler.submit(service) for service in services]
+    left = [len(futures)]
+    lock = threading.Lock()
+    def done(_):
+        with lock:
+            left[0] -= 1
+            if left[0]:
+                return
+        outbox.put((futures, encode))
+    for future in futures:
+        future.add_done_callback(done)
+
+def text_reply(replies):
+    if len(replies) == 1:
+        res = replies[0]
+        if 'error' in res: # refused or expired in the queue: no message of its own
+            res = {'all': 0, 'message': "Busy, try again", **res}
+    else:
+        # several commands in one chunk: one line answers them all, in order
+        res = {'all': 0, 'batch': replies, 'message': random.choice(MESSAGES)}
+    return (json.dumps(res) + '\r\n').encode('utf-8')
+
+def binary_reply(masks):
+    def encode(replies):
+        return b''.join(binary_protocol.encode_reply(res, mask) for res, mask in zip(replies, masks)
+                        if res.get('error') != SUPERSEDED)
+    return encode
+
+def send_replies():
+    while True:
+        item = outbox.get()
+        if item is None:
+            return
+        futures, encode = item
+        try:
+            replies = [future.result() for future in futures]
+            if replies and all(res.get('error') == SUPERSEDED for res in replies):
+                continue # the newer command answers for it
+            log.debug('reply', reply=replies)
+            frame = encode(replies)
+            started = perf_counter()
+            s.send(frame)
+            sub = push
+            if sub is not None:
+                sub.sent(len(frame), perf_counter() - started)
+        except Exception as e:
+            log.warning('send_failed', error=e)
+
+def start_push(hz, mask):
+    # binary 0x87: stream the fields in mask as compact frames, 0 stops
+    global push
+    if hz and mask:
+        push = AdaptiveSubscription(binary_protocol.mask_fields(mask), min(hz, MAX_PUSH_RATE), MIN_PUSH_RATE)
+        log.info('push_started', fields=push.fields, rate=push.rate)
+    elif push is not None:
+        push = None
+        log.info('push_stopped')
+
+def push_telemetry():
+    # Pushes only the fields that changed, from cached values, as 0xC2 frames
+    # without the JSON, "all" flag and message of a reply. Skips a push while
+    # anything is queued so the link never backs up and commands stay quick.
+    while True:
+        sub = push
+        if push_stop.wait(sub.period if sub is not None else PUSH_IDLE):
+            return
+        sub = push
+        if sub is None:
+            continue
+        backlog = outbox.qsize() + scheduler.depth()
+        sub.adjust(backlog)
+        if backlog:
+            continue # unsent changes go out with the next push
+        values = {k: v for k, v in car.telemetry_values(sub.fields).items() if v is not None}
+        delta = sub.delta(values)
+        if not delta:
+            continue
+        frame = binary_protocol.encode_reply(delta, binary_protocol.ALL_MASK, binary_protocol.PUSHED)
+        sub.pushed(len(frame))
+        outbox.put(([], lambda replies, frame=frame: frame))
+
+binary_decoder = binary_protocol.BinaryDecoder()
+framer = CommandFramer()
+
+def client_connected():
+    # a new phone starts with a clean stream
+    global binary_decoder
+    binary_decoder = binary_protocol.BinaryDecoder()
+    framer.reset()
+    start_push(0, 0)
+
+def binary_received(data):
+    global binary_decoder
+    try:
+        requests = binary_decoder.feed(data)
+    except ValueError as e:
+        log.warning('malformed_binary', error=e)
+        binary_decoder = binary_protocol.BinaryDecoder()
+        return
+    queries = []
+    for service, mask in requests:
+        if isinstance(service, str) and service.startswith(PUSH_PREFIX):
+            start_push(int(service[len(PUSH_PREFIX):]), mask) # no scheduler hop, nothing to read
+        else:
+            queries.append((service, mask))
+    if queries:
+        submit([service for service, _ in queries], binary_reply([mask for _, mask in queries]))
+
 def data_received(data):
-    print(f"Received from client: {data}")
-
-    res = handle_client_event(data)
-    # data = {'battery': 76, 'temp': 45}
-    print(res)
-    s.send(json.dumps(res) + '\r\n')
-
-
-try:
-    Vilib.camera_start(vflip=False,hflip=False)
-    Vilib.display(local=True,web=True)
-    sleep(2)
-    s = BluetoothServer(data_received)
-    pause()
-except:
-    Vilib.camera_close()
-    print("end")
+    # raw bytes: binary frames start with a byte >= 0x80, anything else is text
+    if binary_decoder.pending() or (not framer.pending() and binary_protocol.is_binary(data[0])):
+        binary_received(data)
+        return
+    try:
+        services = framer.feed(data)
+    except ValueError as e:
+        log.warning('malformed_text', error=e)
+        framer.reset()
+        return
+    if services:
+        log.debug('request', service=services if len(services) > 1 else services[0])
+        submit(services, text_reply)
+
+
+s = None
+
+def start():
+    # RFCOMM front-end; bluedot runs it on its own threads
+    global s, sender, pusher
+    scheduler.start()
+    sender = threading.Thread(target=send_replies, name="bt-sender", daemon=True)
+    sender.start()
+    push_stop.clear()
+    pusher = threading.Thread(target=push_telemetry, name="bt-push", daemon=True)
+    pusher.start()
+    s = BluetoothServer(data_received, encoding=None, when_client_connects=client_connected)
+
+def stop():
+    push_stop.set()
+    if pusher is not None:
+        pusher.join(timeout=2)
+    scheduler.stop()
+    if sender is not None:
+        outbox.put(None)
+        sender.join(timeout=2)
+    if s is not None:
+        s.stop()
+
+def main():
+    try:
+        car.hw.camera.camera_start(vflip=False,hflip=False)
+        car.hw.camera.display(local=True,web=True)
+        car.start()
+        if METRICS_PORT:
+            metrics.serve_http('0.0.0.0', int(METRICS_PORT))
+        sleep(2)
+        start()
+        pause()
+    except:
+        metrics.stop_http()
+        stop()
+        car.stop()
+        car.hw.camera.camera_close()
+        log.info('stopped')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import json
+import os
+from time import monotonic, sleep
+
+import log
+
+
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration.json')
+CAL_POWERS = (20, 40, 60)
+CAL_DURATION = 1.5 # seconds driven per (direction, power) run
+CAL_SETTLE = 0.3 # seconds of each run ignored while the car accelerates
+CAL_RATE = 50.0 # ultrasonic samples per second during a run
+CAL_PAUSE = 1.0 # seconds stopped between runs
+
+
+def fit_line(points):
+    # least squares y = slope * x + intercept over [(x, y), ...]
+    n = len(points)
+    if n == 0:
+        return 0.0, 0.0
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        # a single power level: assume speed is proportional to power
+        return (mean_y / mean_x if mean_x else 0.0), 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+    return slope, mean_y - slope * mean_x
+
+
+class SpeedModel:
+    # Per-direction linear speed model: speed = slope * power + intercept, in
+    # cm/s. Looking a speed up is a dict access and a multiply, so handlers
+    # and the odometer can use it on every call.
+
+    def __init__(self, coefficients, calibrated=False):
+        self.coefficients = coefficients # direction -> (slope, intercept)
+        self.calibrated = calibrated
+
+    @classmethod
+    def from_rates(cls, rates):
+        # rates: direction -> cm/s per unit of power (the hand-tuned powerDistMap)
+        return cls({direction: (rate, 0.0) for direction, rate in rates.items()})
+
+    def speed(self, direction, power):
+        coefficients = self.coefficients.get(direction)
+        if coefficients is None or power <= 0:
+            return 0.0
+        slope, intercept = coefficients
+        return max(0.0, slope * power + intercept)
+
+    def save(self, path=CALIBRATION_FILE):
+        data = {direction: {'slope': slope, 'intercept': intercept}
+                for direction, (slope, intercept) in self.coefficients.items()}
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+def load_model(defaults, path=CALIBRATION_FILE):
+    # calibrated model if the file exists, else the hand-tuned defaults
+    model = SpeedModel.from_rates(defaults)
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        coefficients = {direction: (float(entry['slope']), float(entry['intercept']))
+                        for direction, entry in data.items()}
+    except FileNotFoundError:
+        return model
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        # unreadable, or not {direction: {"slope": ..., "intercept": ...}}
+        log.warning('calibration_ignored', path=path, error=e)
+        return model
+    model.coefficients.update(coefficients)
+    model.calibrated = True
+    log.info('calibration_loaded', path=path)
+    return model
+
+
+def measure_speed(read_distance, duration=CAL_DURATION, rate=CAL_RATE, settle=CAL_SETTLE):
+    # sample the ultrasonic sensor for `duration` seconds and return the
+    # magnitude of the fitted range slope, in cm/s
+    period = 1.0 / rate
+    started = monotonic()
+    samples = []
+    while True:
+        now = monotonic()
+        elapsed = now - started
+        if elapsed >= duration:
+            break
+        dist = read_distance()
+        # the ultrasonic driver reports timeouts and errors as negative values
+        if elapsed >= settle and dist is not None and dist >= 0:
+            samples.append((now, dist))
+        sleep(max(0, period - (monotonic() - now)))
+    if len(samples) < 2:
+        raise Exception("Not enough ultrasonic readings to measure speed")
+    return abs(fit_line(samples)[0])
+
+
+def calibrate(drive, read_distance, directions, stop_direction, powers=CAL_POWERS,
+              duration=CAL_DURATION, rate=CAL_RATE, settle=CAL_SETTLE, pause=CAL_PAUSE):
+    # Drive every direction at every power, measure the speed of each run and
+    # fit one line per direction. Needs a flat wall in front of the car.
+    coefficients = {}
+    for direction in directions:
+        points = []
+        for power in powers:
+            try:
+                drive(direction, power)
+                speed = measure_speed(read_distance, duration, rate, settle)
+            finally:
+                drive(stop_direction, 0)
+            print(f"Calibration {direction} at power {power}: {speed:.2f} cm/s")
+            points.append((power, speed))
+            sleep(pause)
+        coefficients[direction] = fit_line(points)
+        print(f"Calibration {direction}: speed = {coefficients[direction][0]:.4f} * power "
+              f"+ {coefficients[direction][1]:.2f} cm/s")
+    return SpeedModel(coefficients, calibrated=True)
@@ -0,0 +1,294 @@
+import json
+import threading
+
+from battery import BatteryMonitor
+from calibration import load_model
+from commands import CommandTable
+from hardware import open_hardware, instrument
+import log
+from metrics import Metrics
+from motion_plan import MotionPlanner, parse_segments
+from motor import MotorOutput
+from odometry import Odometer
+from speed_estimator import SpeedEstimator
+from thermal import active_flags
+from telemetry import Sample, TelemetrySampler
+from vehicle import Vehicle
+
+
+# The car and its commands, shared by the Wi-Fi and Bluetooth servers.
+# The servers only deal with their transport and hand every service to handle().
+
+INITIAL_POWER = 10
+LEFT, RIGHT, FORWARD, BACKWARD, STOP = 'left', 'right', 'forward', 'backward', 'stop'
+powerDistMap = { # cm/s per unit of power, until calibration.json exists
+    FORWARD: 0.3,
+    BACKWARD: 0.1,
+    LEFT: 0.15,
+    RIGHT: 0.13,
+}
+speed_model = load_model(powerDistMap) # calibration.json, see calibration.py
+# background sampling period of each sensor, in seconds
+BATTERY_INTERVAL, TEMP_INTERVAL = 1.0, 2.0
+BATTERY_WINDOW = 10 # battery readings averaged into the reported voltage
+FIELD_TIMEOUTS = {'battery': 0.5, 'temperature': 0.5, 'speed': 0.5} # seconds before a composite reply goes without the field
+MOTOR_COALESCE = 0.02 # seconds within which motor commands are merged into one update
+SPEED_RATE, SPEED_WINDOW = 20.0, 1.0 # ultrasonic samples per second, regression window in seconds
+ODOMETRY_RATE, ODOMETRY_HISTORY = 20.0, 300 # integration steps per second, seconds of history kept
+# request scheduling, the same for both servers
+QUEUE_SIZE = 16 # requests waiting for a worker before new ones get a "busy" reply
+MOTOR_PRIORITY, TELEMETRY_PRIORITY = 0, 1
+DEADLINES = {MOTOR_PRIORITY: 0.5, TELEMETRY_PRIORITY: 2.0} # seconds a request may wait in the queue
+
+metrics = Metrics()
+hw = instrument(open_hardware(), metrics) # PICAR_HARDWARE=real or sim
+px = hw.px
+motors = MotorOutput(px, MOTOR_COALESCE)
+battery = BatteryMonitor(hw.bus, BATTERY_WINDOW)
+thermal = hw.thermal
+
+
+def read_speed():
+    # read-through when nothing was published lately; stamped with the time of
+    # the last real estimate so a stalled sensor shows up as an old sample
+    return Sample(round(speed_estimator.speed(), 2), speed_estimator.updated())
+
+def read_temperature():
+    temperature = thermal.read_temperature()
+    log.info('temperature', backend=thermal.name, value=temperature)
+    return temperature
+
+def fill_temperature(res):
+    # only the throttle flags that are set; the "throttled" service has the full decode
+    sampler.fill(res, 'temperature')
+    throttled = sampler.snapshot().get('throttled')
+    if throttled is not None and throttled.value is not None:
+        res['throttled'] = active_flags(throttled.value)
+
+def report_throttled(res, _):
+    throttled = sampler.snapshot().get('throttled')
+    res['throttled'] = throttled.value if throttled is not None else None
+
+def read_battery_level():
+    battery_percent = battery.read()
+    log.info('battery', raw=battery.raw, voltage=round(battery.voltage, 2),
+             filtered=round(battery.filtered_voltage, 2), percent=battery_percent)
+    return battery_percent
+
+def fill_battery(res):
+    sampler.fill(res, 'battery')
+    res.update(battery.status())
+
+sampler = TelemetrySampler()
+sampler.add_sensor('battery', read_battery_level, BATTERY_INTERVAL)
+sampler.add_sensor('temperature', read_temperature, TEMP_INTERVAL)
+sampler.add_sensor('throttled', thermal.read_throttled, TEMP_INTERVAL)
+sampler.add_sensor('speed', read_speed)
+log.sample('battery', 10) # the pollers log every reading; keep one in ten
+log.sample('temperature', 10)
+speed_estimator = SpeedEstimator(px.ultrasonic.read, SPEED_RATE, SPEED_WINDOW,
+                                 on_update=lambda speed, ts: sampler.publish('speed', round(speed, 2), ts))
+
+def fill_speed(res):
+    if speed_model.calibrated:
+        res['speed'] = round(travel_rate(), 2) # from the model, no sensor involved
+    else:
+        sampler.fill(res, 'speed')
+
+SENSOR_FILLERS = {'battery': fill_battery, 'temperature': fill_temperature, 'speed': fill_speed}
+FIELD_ALIASES = {'batt': 'battery', 'temp': 'temperature', 'dist': 'distance', 'direction': 'dir'}
+ALL_FIELDS = ('battery', 'temperature', 'speed', 'power', 'distance')
+
+def read_fields(fields):
+    # composite query: independent sensor reads run concurrently
+    fields = [FIELD_ALIASES.get(f, f) for f in fields]
+    unknown = [f for f in fields if f not in SENSOR_FILLERS and f not in ('power', 'distance', 'dir')]
+    if unknown:
+        raise Exception(f"Unknown fields: {unknown}")
+    res = sampler.gather({f: SENSOR_FILLERS[f] for f in fields if f in SENSOR_FILLERS}, FIELD_TIMEOUTS)
+    state = vehicle.state
+    live = {'power': state.power, 'distance': returnDistance(odometer.distance()), 'dir': state.direction}
+    for f in fields:
+        if f in live:
+            res[f] = live[f]
+    return res
+
+def telemetry_values(fields):
+    # only cached and in-memory values, so pushing never touches the hardware
+    snap = sampler.snapshot()
+    state = vehicle.state
+    live = {'power': state.power, 'distance': returnDistance(odometer.distance()), 'dir': state.direction}
+    if speed_model.calibrated:
+        live['speed'] = round(speed_model.speed(state.direction, state.power), 2)
+    values = {}
+    for field in fields:
+        if field in live:
+            values[field] = live[field]
+        elif field in snap:
+            values[field] = snap[field].value
+    return values
+
+def travel_rate():
+    # cm/s implied by the current direction and power
+    state = vehicle.state
+    return speed_model.speed(state.direction, state.power)
+
+odometer = Odometer(travel_rate, ODOMETRY_RATE, ODOMETRY_HISTORY)
+
+def returnDistance(dist):
+    return round(dist, 2)
+
+def move(direction, power):
+    # (servo angle, motor 1, motor 2); only changed channels reach the hardware
+    if direction == STOP:
+        motors.set(None, 0, 0)
+    elif direction == FORWARD:
+        motors.set(0, power*0.6, -power)
+    elif direction == BACKWARD:
+        motors.set(0, -power, power*1.6)
+    elif direction == LEFT:
+        motors.set(-30, -power, -power)
+    elif direction == RIGHT:
+        motors.set(30, power, power)
+
+DIRECTIONS = {
+    'l': LEFT, LEFT: LEFT,
+    'r': RIGHT, RIGHT: RIGHT,
+    'f': FORWARD, FORWARD: FORWARD,
+    'b': BACKWARD, BACKWARD: BACKWARD,
+    's': STOP, STOP: STOP,
+}
+
+# Only the vehicle thread changes direction and power or drives the motors.
+# It closes the odometer interval at the old speed before every change.
+vehicle = Vehicle(STOP, INITIAL_POWER, move, before_change=lambda old, new: odometer.mark())
+
+def drive(direction, new_power):
+    # one motion plan segment; a stop keeps the power for the next segment.
+    # Doesn't wait, so segment edges stay on the planner's schedule.
+    vehicle.submit(direction, None if direction == STOP else new_power)
+
+planner = MotionPlanner(drive, STOP)
+
+def start_plan(raw):
+    # raw: list of segments, [{"dir": "f", "power": 30, "duration": 1.5}, ...]
+    res = {}
+    try:
+        segments = parse_segments(raw, DIRECTIONS)
+    except (ValueError, TypeError) as e:
+        res['error'] = str(e)
+        return res
+    res['plan'] = planner.submit(segments)
+    res['segments'] = len(segments)
+    return res
+
+
+def fill_motion(res, state):
+    fill_speed(res)
+    res['power'] = state.power
+    res['distance'] = returnDistance(odometer.distance())
+
+def set_direction(res, direction):
+    # dir reports, dir.<l|r|f|b|s> steers
+    state = vehicle.state
+    if direction is not None:
+        planner.cancel(stop=False) # manual driving takes over from a plan
+        log.debug('direction', direction=direction)
+        state = vehicle.change(direction=direction)
+    res['dir'] = state.direction
+    fill_motion(res, state)
+
+def set_power(res, new_power):
+    # power reports, power.<n> sets the throttle
+    if new_power is not None:
+        if not 0 <= new_power <= 100:
+            raise ValueError(f"Power out of range: {new_power}")
+        planner.cancel(stop=False)
+        log.debug('new_power', power=new_power)
+    state = vehicle.change(power=new_power) # a bare "power" rewrites the motors too
+    fill_motion(res, state)
+
+def report_speed(res, _):
+    fill_speed(res)
+    res['power'] = vehicle.state.power
+
+def report_distance(res, seconds):
+    # dist.<n>: also the distance covered over the last n seconds
+    res['distance'] = returnDistance(odometer.distance())
+    if seconds is not None:
+        res['interval'] = {'seconds': seconds, 'distance': returnDistance(odometer.distance_over(seconds))}
+
+def plan_command(res, raw):
+    # plan / plan.status reports progress, "plan [...]" starts one
+    if raw is None:
+        res['plan'] = planner.progress()
+    else:
+        res.update(start_plan(raw))
+
+def cancel_plan(res, _):
+    res['cancelled'] = planner.cancel()
+    res['plan'] = planner.progress()
+
+commands = CommandTable()
+commands.register('dir', set_direction, choices=DIRECTIONS, motor=True)
+commands.register('power', set_power, arg=int, motor=True)
+commands.register('battery', lambda res, _: fill_battery(res), aliases=('batt',))
+commands.register('temp', lambda res, _: fill_temperature(res), aliases=('temperature',))
+commands.register('throttled', report_throttled, aliases=('throttle',))
+commands.register('speed', report_speed)
+commands.register('dist', report_distance, aliases=('distance',), arg=float)
+commands.register('plan', plan_command, aliases=('plan.status',), arg=json.loads)
+commands.register('plan.cancel', cancel_plan)
+commands.register('motors', lambda res, _: res.update(motors=motors.stats()), aliases=('motor',))
+commands.register('metrics', lambda res, _: res.update(metrics=metrics.snapshot()))
+commands.register('all', lambda res, _: res.update(read_fields(ALL_FIELDS)))
+
+metrics.classify = commands.name
+
+def service_priority(service):
+    # steering and throttle always run before telemetry reads
+    if commands.is_motor(service):
+        return MOTOR_PRIORITY
+    return TELEMETRY_PRIORITY
+
+def steering_key(service):
+    # a newer dir.x (or power.n) replaces one that is still queued; a bare
+    # dir/power only reports, so it never replaces a real command
+    if commands.is_motor(service):
+        return commands.name(service)
+    return None
+metrics.add_gauge('threads', threading.active_count)
+metrics.add_gauge('motor_writes', lambda: motors.writes)
+metrics.add_gauge('motor_writes_saved', lambda: motors.saved)
+
+
+def handle(service, res):
+    # Runs one request into res and returns the command name. A list is a
+    # composite read of those fields. Raises commands.UnknownCommand.
+    if not isinstance(service, (str, list)):
+        raise ValueError(f"Service must be a string or a list of fields, not {type(service).__name__}")
+    if isinstance(service, list):
+        log.debug('service', service=service)
+        res.update(read_fields(service))
+        return 'fields'
+    return commands.dispatch(service, res)
+
+
+def start():
+    motors.start()
+    vehicle.start()
+    planner.start()
+    odometer.start()
+    if not speed_model.calibrated:
+        speed_estimator.start()
+    sampler.start()
+
+def stop():
+    sampler.stop()
+    speed_estimator.stop()
+    odometer.stop()
+    battery.close()
+    thermal.close()
+    planner.close()
+    vehicle.close()
+    motors.close()
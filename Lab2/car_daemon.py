@@ -0,0 +1,59 @@
+import argparse
+from signal import pause
+
+import car
+from car import metrics
+import log
+import wifi_electron_server as wifi
+
+
+# One process owns the car and serves both apps at once. The desktop
+# dashboard connects over Wi-Fi (TCP, optional UDP) and the phone app over
+# Bluetooth (RFCOMM). Both front-ends share car.py: a single Picarx, one
+# vehicle state, one sensor cache and one command table.
+#
+#   python3 car_daemon.py                  # Wi-Fi and Bluetooth
+#   python3 car_daemon.py --no-bluetooth   # Wi-Fi only, e.g. with PICAR_HARDWARE=sim
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PiCar-X daemon serving Wi-Fi and Bluetooth clients")
+    wifi.add_arguments(parser)
+    parser.add_argument('--no-wifi', action='store_true', help="do not serve TCP/UDP clients")
+    parser.add_argument('--no-bluetooth', action='store_true', help="do not serve RFCOMM clients")
+    args = parser.parse_args()
+    if args.no_wifi and args.no_bluetooth:
+        parser.error("nothing to serve")
+    bluetooth = None
+    if not args.no_bluetooth:
+        import bluz_flutter_server as bluetooth # needs bluedot, only imported when used
+    car.speed_estimator.rate, car.speed_estimator.window = args.speed_rate, args.speed_window
+
+    car.hw.camera.camera_start(vflip=False,hflip=False)
+    car.hw.camera.display(local=True,web=True)
+    car.start()
+    if args.metrics_port:
+        metrics.serve_http(args.host, args.metrics_port)
+    try:
+        if bluetooth is not None:
+            bluetooth.start()
+            log.info('frontend_started', frontend='bluetooth')
+        if not args.no_wifi:
+            wifi.start(args)
+            log.info('frontend_started', frontend='wifi', host=args.host, port=args.port, engine=args.engine)
+            wifi.serve(args)
+        else:
+            pause()
+    except KeyboardInterrupt:
+        log.info('shutting_down')
+    finally:
+        metrics.stop_http()
+        if bluetooth is not None:
+            bluetooth.stop()
+        if not args.no_wifi:
+            wifi.stop()
+        car.stop()
+    car.hw.camera.camera_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from collections import namedtuple
+
+import log
+
+
+# handler(res, arg) fills the reply dict res; arg is the parsed argument or None
+Command = namedtuple('Command', ['name', 'handler', 'motor'])
+
+SEPARATORS = '. ' # "power.30", "dist.10", "plan [...]"
+CACHE_SIZE = 256 # parsed service strings kept for reuse
+CACHE_MAX_LEN = 32 # longer strings (plan JSON) are parsed every time
+
+
+class UnknownCommand(Exception):
+    pass
+
+
+class CommandTable:
+    # Maps service strings to handlers with dict lookups instead of an
+    # if/elif chain. Commands without an argument, their aliases, and every
+    # fixed argument (dir.l, dir.left, ...) are exact keys. Commands with a
+    # free argument (power.<n>) are looked up by the name before the first
+    # separator, and the argument is converted once. Parsed strings are cached.
+
+    def __init__(self):
+        self._exact = {} # service -> (Command, arg)
+        self._parsers = {} # name -> (Command, convert)
+        self._cache = {}
+
+    def register(self, name, handler, aliases=(), arg=None, choices=None, motor=False):
+        # arg: converter for a free argument, e.g. int for "power.<n>".
+        # choices: fixed arguments, {"l": LEFT, "left": LEFT, ...} for "dir.<x>".
+        # The bare name (and aliases) run the handler with arg None.
+        command = Command(name, handler, motor)
+        for key in (name, *aliases):
+            self._exact[key] = (command, None)
+            for text, value in (choices or {}).items():
+                self._exact[f"{key}.{text}"] = (command, value)
+            if arg is not None:
+                self._parsers[key] = (command, arg)
+        self._cache.clear()
+        return command
+
+    def lookup(self, service):
+        # (Command, arg) for a service string; raises UnknownCommand
+        found = self._exact.get(service) or self._cache.get(service)
+        if found is not None:
+            return found
+        for i, c in enumerate(service):
+            if c in SEPARATORS:
+                parser = self._parsers.get(service[:i])
+                if parser is None:
+                    break
+                command, convert = parser
+                try:
+                    found = (command, convert(service[i + 1:]))
+                except (ValueError, TypeError) as e:
+                    raise ValueError(f"Bad argument for {command.name}: {str(e)}")
+                if len(service) <= CACHE_MAX_LEN:
+                    if len(self._cache) >= CACHE_SIZE:
+                        self._cache.clear()
+                    self._cache[service] = found
+                return found
+        raise UnknownCommand(f"Unknown service: {service}")
+
+    def name(self, service):
+        # command name for metrics labels; unknown strings share one label
+        if isinstance(service, list):
+            return 'fields'
+        if not isinstance(service, str):
+            return 'unknown'
+        try:
+            return self.lookup(service)[0].name
+        except (UnknownCommand, ValueError):
+            return 'unknown'
+
+    def is_motor(self, service):
+        # True for a motor command that changes something (dir.f, power.30);
+        # the bare name only reports the current value
+        if not isinstance(service, str):
+            return False
+        try:
+            command, arg = self.lookup(service)
+        except (UnknownCommand, ValueError):
+            return False
+        return command.motor and arg is not None
+
+    def dispatch(self, service, res):
+        # runs the command into res and returns its name
+        command, arg = self.lookup(service)
+        log.debug('service', service=service)
+        command.handler(res, arg)
+        return command.name
@@ -47,51 +47,91 @@ function updateElement(element, data) {
     }
 }
 
-function client(input){
-    
-    const net = require('net');
-    if (!(input)) {
-        input = document.getElementById("message").value;
-    }
+const net = require('net');
 
-    const client = net.createConnection({ port: server_port, host: server_addr }, () => {
+// one long-lived connection; requests carry an id and replies are matched to it
+var conn = null;
+var recvBuffer = '';
+var nextId = 1;
+const pending = {};
+const pushRate = 5; // telemetry pushes per second
+
+function connect() {
+    conn = net.createConnection({ port: server_port, host: server_addr }, () => {
         // 'connect' listener.
         console.log('connected to server!');
-
-        // send the message
-        const message = {
-            service: input,
-        };
-        client.write(JSON.stringify(message) + '\n');
     });
-    
-    // get the data from the server
-    client.on('data', (data) => {
-        try {
-            const jsonData = JSON.parse(data.toString());
-            console.log(`jsonData: ${jsonData}`);
-            document.getElementById("returnedData").innerHTML = JSON.stringify(jsonData);
-            for (const key in watchingParameters) {
-                if (!(key in jsonData)) {
-                    continue;
-                }
-                var newValue = jsonData[key];
-                if (!(isNaN(newValue))) {
-                    newValue = (newValue < 1) ? 0 : Number(newValue);
-                }
-                updateElement(key, newValue);
+    conn.setNoDelay(true);
+    // the server pushes changed telemetry instead of us polling for it
+    send({ service: 'subscribe', fields: Object.keys(watchingParameters), rate: pushRate });
+
+    // get the data from the server, one JSON reply per line
+    conn.on('data', (data) => {
+        recvBuffer += data.toString();
+        const lines = recvBuffer.split('\n');
+        recvBuffer = lines.pop();
+        lines.forEach(line => {
+            if (line.trim()) {
+                handleReply(line);
             }
-        } catch (err) {
-            console.error('Failed to parse JSON:', err);
-        }
-        client.end();
-        client.destroy();
+        });
     });
 
-    client.on('end', () => {
+    conn.on('error', (err) => {
+        console.error('Connection error:', err);
+    });
+
+    conn.on('close', () => {
         console.log('disconnected from server');
+        conn = null;
+        recvBuffer = '';
+        for (const id in pending) {
+            delete pending[id];
+        }
     });
+}
+
+function handleReply(line) {
+    try {
+        const jsonData = JSON.parse(line);
+        console.log(`jsonData: ${jsonData}`);
+        if ('id' in jsonData) {
+            // pushes carry only 'sub'; replies to our own requests carry 'id'
+            delete pending[jsonData.id];
+            document.getElementById("returnedData").innerHTML = JSON.stringify(jsonData);
+        }
+        for (const key in watchingParameters) {
+            if (!(key in jsonData)) {
+                continue;
+            }
+            var newValue = jsonData[key];
+            if (!(isNaN(newValue))) {
+                newValue = (newValue < 1) ? 0 : Number(newValue);
+            }
+            updateElement(key, newValue);
+        }
+    } catch (err) {
+        console.error('Failed to parse JSON:', err);
+    }
+}
+
+function client(input){
+
+    if (!(input)) {
+        input = document.getElementById("message").value;
+    }
+    if (conn === null) {
+        connect();
+    }
+
+    // send the message
+    send({ service: input });
+}
 
+function send(message) {
+    message.id = nextId++;
+    pending[message.id] = message.service;
+    conn.write(JSON.stringify(message) + '\n');
 }
 
 // update data for every 50ms
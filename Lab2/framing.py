@@ -0,0 +1,31 @@
+MAX_PENDING = 4096 # bytes of an unfinished command kept before the stream is reset
+
+
+class CommandFramer:
+    # Splits the RFCOMM byte stream into text commands. RFCOMM does not keep
+    # write boundaries: a fast client's commands can arrive split across
+    # callbacks or several in one. Every command ends in "\n" (or "\r\n");
+    # the unfinished tail is kept for the next chunk.
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self._buf = b''
+
+    def pending(self):
+        return bool(self._buf)
+
+    def reset(self):
+        self._buf = b''
+
+    def feed(self, data):
+        # returns the complete commands in data, in order; raises ValueError
+        *complete, self._buf = (self._buf + data).split(b'\n')
+        if len(self._buf) > self.max_pending:
+            self._buf = b''
+            raise ValueError(f"Command longer than {self.max_pending} bytes")
+        commands = []
+        for line in complete:
+            command = line.decode('utf-8').strip()
+            if command:
+                commands.append(command)
+        return commands
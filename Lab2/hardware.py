@@ -0,0 +1,60 @@
+import os
+from collections import namedtuple
+
+import log
+from thermal import open_backend
+
+
+# Everything the servers touch on the car, from one place.
+# px: picarx.Picarx-like, bus: SMBus-like, thermal: a thermal.py backend,
+# camera: vilib.Vilib-like
+Hardware = namedtuple('Hardware', ['name', 'px', 'bus', 'thermal', 'camera'])
+
+
+def open_real():
+    # imported here so the simulator runs on machines without the car libraries
+    from picarx import Picarx
+    from smbus import SMBus
+    from vilib import Vilib
+    thermal = open_backend(os.environ.get('PICAR_THERMAL', 'auto')) # auto, sysfs or vcgencmd
+    return Hardware('real', Picarx(), SMBus(1), thermal, Vilib)
+
+
+def open_sim():
+    from sim_hardware import SimWorld, SimPicarx, SimSMBus, SimThermal, SimCamera, sim_config
+    world = SimWorld(sim_config())
+    log.info('simulated_hardware', config=world.config)
+    return Hardware('sim', SimPicarx(world), SimSMBus(world), SimThermal(world), SimCamera)
+
+
+BACKENDS = {'real': open_real, 'sim': open_sim}
+
+
+class Instrumented:
+    # Forwards everything to target; the methods listed are timed into metrics
+
+    def __init__(self, target, metrics, methods):
+        self._target = target
+        for name, kind in methods.items():
+            setattr(self, name, metrics.timed(kind, getattr(target, name)))
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+
+def instrument(hw, metrics):
+    # time every ultrasonic read, motor/servo write, I2C transaction and thermal read
+    px = Instrumented(hw.px, metrics, {'set_motor_speed': 'motor', 'set_dir_servo_angle': 'motor'})
+    px.ultrasonic = Instrumented(hw.px.ultrasonic, metrics, {'read': 'ultrasonic'})
+    bus = Instrumented(hw.bus, metrics, {'write_word_data': 'i2c', 'read_byte': 'i2c'})
+    kind = 'subprocess' if hw.thermal.name == 'vcgencmd' else 'thermal'
+    thermal = Instrumented(hw.thermal, metrics, {'read_temperature': kind, 'read_throttled': kind})
+    return hw._replace(px=px, bus=bus, thermal=thermal)
+
+
+def open_hardware(name=None):
+    if name is None:
+        name = os.environ.get('PICAR_HARDWARE', 'real') # real or sim
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown hardware backend: {name}")
+    return BACKENDS[name]()
@@ -0,0 +1,118 @@
+import atexit
+import json
+import os
+import sys
+import threading
+from queue import SimpleQueue
+from time import time, strftime, localtime
+
+
+# Structured event log with a background writer.
+#
+#   log.info('connected', peer=addr)
+#   log.debug('service', service=service)
+#
+# The calling thread only checks the level (and the sampling counter) and
+# puts a tuple on a queue. Formatting, str() of the field values and the
+# write to stdout all happen on the writer thread. Field values are
+# formatted later, so pass values that are not mutated afterwards.
+#
+# PICAR_LOG_LEVEL=debug|info|warning|error (default info)
+# PICAR_LOG_FORMAT=text|json (default text)
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+
+class Logger:
+
+    def __init__(self, level=INFO, fmt='text', stream=None):
+        self.level = level
+        self.fmt = fmt
+        self.stream = stream
+        self.dropped = 0 # events skipped by sampling
+        self._sampling = {} # event -> log 1 in every n
+        self._counts = {}
+        self._queue = SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def sample(self, event, every):
+        # high-frequency events: only every n-th one is written
+        self._sampling[event] = every
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        # flushes everything queued so far
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout=2)
+
+    def log(self, level, event, fields):
+        if level < self.level:
+            return
+        every = self._sampling.get(event)
+        if every:
+            count = self._counts[event] = self._counts.get(event, 0) + 1
+            if count % every:
+                self.dropped += 1
+                return
+            fields['sampled'] = every
+        if self._thread is None:
+            self.start()
+        self._queue.put((time(), level, event, fields))
+
+    def debug(self, event, **fields):
+        self.log(DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self.log(INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self.log(WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self.log(ERROR, event, fields)
+
+    def format(self, record):
+        ts, level, event, fields = record
+        if self.fmt == 'json':
+            return json.dumps({'ts': round(ts, 3), 'level': LEVEL_NAMES[level], 'event': event, **fields}, default=str)
+        stamp = strftime('%H:%M:%S', localtime(ts)) + f".{int(ts * 1000) % 1000:03d}"
+        values = ' '.join(f"{key}={value}" for key, value in fields.items())
+        return f"{stamp} {LEVEL_NAMES[level]:<7} {event} {values}".rstrip()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            # write whatever else queued up meanwhile, then flush once
+            lines = []
+            while record is not None:
+                try:
+                    lines.append(self.format(record))
+                except Exception as e:
+                    lines.append(f"Error occured while formatting log event {record[2]}: {str(e)}")
+                if self._queue.empty():
+                    break
+                record = self._queue.get()
+            stream = self.stream or sys.stdout
+            if lines:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            if record is None:
+                return
+
+
+logger = Logger(LEVELS.get(os.environ.get('PICAR_LOG_LEVEL', 'info').lower(), INFO),
+                os.environ.get('PICAR_LOG_FORMAT', 'text'))
+debug, info, warning, error, sample = logger.debug, logger.info, logger.warning, logger.error, logger.sample
@@ -0,0 +1,188 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, time
+
+import log
+
+
+# upper bounds in seconds; one more bucket catches everything slower
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+PERCENTILES = (50, 95, 99)
+
+
+def service_name(service):
+    # one label per family, so dir.f/dir.l or power.10/power.30 share a series
+    if isinstance(service, list):
+        return 'fields'
+    return str(service).split('.', 1)[0].split(' ', 1)[0] or 'unknown'
+
+
+class Histogram:
+    # Fixed buckets: observe() is a bisect and a few increments under a lock,
+    # cheap enough for every request and every hardware call.
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile
+        if not self.count:
+            return None
+        rank = p * self.count / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def summary(self):
+        summary = {'count': self.count}
+        if self.count:
+            summary['mean_ms'] = round(self.sum / self.count * 1000, 3)
+            for p in PERCENTILES:
+                summary[f"p{p}_ms"] = round(self.percentile(p) * 1000, 3)
+        return summary
+
+
+class Metrics:
+    # Request counters and latency histograms per service, latency
+    # histograms per kind of hardware call, and gauges read at export time.
+
+    def __init__(self):
+        self.started = time()
+        self.requests = {} # service -> Histogram
+        self.errors = {} # service -> count
+        self.hardware = {} # kind -> Histogram
+        self.gauges = {} # name -> fn()
+        self.classify = service_name # service -> label
+        self._lock = threading.Lock()
+        self._http = None
+
+    def _histogram(self, table, name):
+        histogram = table.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = table.setdefault(name, Histogram())
+        return histogram
+
+    def observe_request(self, service, seconds):
+        self._histogram(self.requests, self.classify(service)).observe(seconds)
+
+    def count_error(self, service):
+        name = self.classify(service)
+        with self._lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def track(self, handler):
+        # wraps a service handler, handler(service, ...) -> reply
+        def tracked(service, *args, **kwargs):
+            started = perf_counter()
+            try:
+                return handler(service, *args, **kwargs)
+            finally:
+                self.observe_request(service, perf_counter() - started)
+        return tracked
+
+    def timed(self, kind, fn):
+        # wraps one hardware call so every invocation lands in the `kind` histogram
+        histogram = self._histogram(self.hardware, kind)
+        def call(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - started)
+        return call
+
+    def add_gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def read_gauges(self):
+        values = {}
+        for name, fn in self.gauges.items():
+            try:
+                values[name] = fn()
+            except Exception as e:
+                log.error('gauge_failed', gauge=name, error=e)
+        return values
+
+    def snapshot(self):
+        services = {}
+        for name, histogram in list(self.requests.items()):
+            services[name] = histogram.summary()
+            services[name]['errors'] = self.errors.get(name, 0)
+        return {
+            'uptime': round(time() - self.started, 1),
+            'services': services,
+            'hardware': {kind: histogram.summary() for kind, histogram in list(self.hardware.items())},
+            'gauges': self.read_gauges(),
+        }
+
+    def prometheus(self, prefix='picar'):
+        lines = []
+        def histogram_lines(metric, label, table):
+            lines.append(f"# TYPE {metric} histogram")
+            for name, histogram in list(table.items()):
+                with histogram._lock:
+                    counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+                cumulative = 0
+                for bound, bucket in zip(histogram.buckets + ('+Inf',), counts):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {total}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {count}')
+        histogram_lines(f"{prefix}_request_seconds", 'service', self.requests)
+        lines.append(f"# TYPE {prefix}_request_errors_total counter")
+        for name, count in list(self.errors.items()):
+            lines.append(f'{prefix}_request_errors_total{{service="{name}"}} {count}')
+        histogram_lines(f"{prefix}_hardware_seconds", 'call', self.hardware)
+        for name, value in self.read_gauges().items():
+            if isinstance(value, (int, float)):
+                lines.append(f"# TYPE {prefix}_{name} gauge")
+                lines.append(f"{prefix}_{name} {value}")
+        lines.append(f"# TYPE {prefix}_uptime_seconds gauge")
+        lines.append(f"{prefix}_uptime_seconds {round(time() - self.started, 1)}")
+        return '\n'.join(lines) + '\n'
+
+    def serve_http(self, host, port):
+        # Prometheus text format on http://host:port/metrics, from a daemon thread
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._http = ThreadingHTTPServer((host, port), Handler)
+        self._http.daemon_threads = True
+        threading.Thread(target=self._http.serve_forever, name="metrics-http", daemon=True).start()
+        log.info('metrics_http', url=f"http://{host}:{port}/metrics")
+
+    def stop_http(self):
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+            self._http = None
@@ -0,0 +1,149 @@
+import itertools
+import threading
+from collections import namedtuple
+from time import perf_counter
+
+import log
+
+
+Segment = namedtuple('Segment', ['direction', 'power', 'duration'])
+
+MAX_SEGMENTS = 64
+MAX_DURATION = 30.0 # seconds per segment
+SPIN = 0.002 # busy-wait the last few ms of a segment for sub-millisecond edges
+IDLE, RUNNING, DONE, CANCELLED = 'idle', 'running', 'done', 'cancelled'
+
+
+def parse_segments(raw, directions):
+    # raw: [{"dir": "f", "power": 30, "duration": 1.5}, ...] or [["f", 30, 1.5], ...]
+    if not isinstance(raw, list) or not raw:
+        raise ValueError("A plan needs a non-empty list of segments")
+    if len(raw) > MAX_SEGMENTS:
+        raise ValueError(f"A plan can have at most {MAX_SEGMENTS} segments")
+    segments = []
+    for item in raw:
+        if isinstance(item, dict):
+            item = (item.get('dir'), item.get('power'), item.get('duration'))
+        direction, power, duration = item
+        if direction not in directions:
+            raise ValueError(f"Unknown direction in plan: {direction}")
+        power, duration = int(power), float(duration)
+        if not 0 <= power <= 100:
+            raise ValueError(f"Power out of range in plan: {power}")
+        if not 0 < duration <= MAX_DURATION:
+            raise ValueError(f"Segment duration out of range in plan: {duration}")
+        segments.append(Segment(directions[direction], power, duration))
+    return segments
+
+
+class MotionPlanner:
+    # Runs a list of timed motion segments on the car from one dedicated
+    # thread. Segment boundaries are scheduled against absolute perf_counter
+    # deadlines from the plan's start, so timing errors never accumulate.
+    # A new plan pre-empts the running one; cancel() stops it early. Either
+    # way the car is stopped when a plan ends, unless the caller takes over
+    # the motors itself (cancel(stop=False) before a manual command).
+
+    def __init__(self, drive, stop_direction):
+        self.drive = drive # drive(direction, power) applies one segment
+        self.stop_direction = stop_direction
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._queued = None # (plan id, segments) waiting to start
+        self._abort = False
+        self._stop_after = True # stop the car when the current plan is aborted
+        self._status = {'plan': None, 'state': IDLE}
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="motion-plan", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._abort = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def submit(self, segments):
+        with self._cond:
+            plan_id = next(self._ids)
+            self._queued = (plan_id, segments)
+            self._abort = True # pre-empt whatever is running
+            self._stop_after = False # the new plan sets its own first segment
+            self._cond.notify()
+        return plan_id
+
+    def cancel(self, stop=True):
+        with self._cond:
+            active = self._queued is not None or self._status['state'] == RUNNING
+            self._queued = None
+            self._abort = True
+            self._stop_after = stop
+            self._cond.notify()
+        return active
+
+    def progress(self):
+        status = dict(self._status)
+        if status['state'] == RUNNING:
+            status['elapsed'] = round(perf_counter() - status.pop('started'), 3)
+            status['remaining'] = round(max(0, status['total'] - status['elapsed']), 3)
+        else:
+            status.pop('started', None)
+        return status
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and self._queued is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                plan_id, segments = self._queued
+                self._queued = None
+                self._abort = False
+                self._stop_after = True
+            self._execute(plan_id, segments)
+
+    def _execute(self, plan_id, segments):
+        started = perf_counter()
+        total = sum(s.duration for s in segments)
+        state = DONE
+        deadline = started
+        for index, segment in enumerate(segments):
+            self._status = {'plan': plan_id, 'state': RUNNING, 'segment': index,
+                            'segments': len(segments), 'started': started, 'total': round(total, 3)}
+            try:
+                self.drive(segment.direction, segment.power)
+            except Exception as e:
+                log.error('plan_failed', plan=plan_id, segment=index, error=e)
+                state = CANCELLED
+                break
+            deadline += segment.duration
+            if not self._wait_until(deadline):
+                state = CANCELLED
+                break
+        if state == DONE or self._stop_after:
+            self.drive(self.stop_direction, 0)
+        self._status = {'plan': plan_id, 'state': state, 'segment': index, 'segments': len(segments),
+                        'total': round(total, 3)}
+
+    def _wait_until(self, deadline):
+        # False if the plan was cancelled or pre-empted before the deadline
+        with self._cond:
+            while not self._abort:
+                remaining = deadline - perf_counter()
+                if remaining <= SPIN:
+                    break
+                self._cond.wait(remaining - SPIN)
+            if self._abort:
+                return False
+        while perf_counter() < deadline:
+            if self._abort:
+                return False
+        return True
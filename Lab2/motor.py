@@ -0,0 +1,84 @@
+import threading
+from time import monotonic
+
+
+SERVO, LEFT_MOTOR, RIGHT_MOTOR = 'servo', 1, 2
+
+
+class MotorOutput:
+    # Single writer for the steering servo and both drive motors.
+    # set() only records the wanted state; a writer thread applies it, writing
+    # just the channels whose value differs from what the hardware already
+    # has. Commands arriving within `coalesce` seconds of the last hardware
+    # update are merged: only the newest one is written when the window ends.
+
+    def __init__(self, px, coalesce=0.02):
+        self.px = px
+        self.coalesce = coalesce
+        self.writes = 0 # channel writes sent to the hardware
+        self.saved = 0 # channel writes skipped (unchanged or superseded)
+        self._applied = {SERVO: None, LEFT_MOTOR: None, RIGHT_MOTOR: None}
+        self._pending = None
+        self._last_update = 0.0
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="motor-output", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        # never leave the wheels turning once nothing is driving them
+        self._apply({LEFT_MOTOR: 0, RIGHT_MOTOR: 0})
+
+    def set(self, servo, left, right):
+        # servo=None leaves the steering where it is
+        target = {} if servo is None else {SERVO: servo}
+        target[LEFT_MOTOR], target[RIGHT_MOTOR] = left, right
+        with self._cond:
+            if self._pending is not None:
+                self.saved += len(self._pending)
+            self._pending = target
+            self._cond.notify()
+
+    def stats(self):
+        return {'writes': self.writes, 'saved': self.saved}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and self._pending is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                # let the rest of a burst land, then write only the newest
+                while self._running:
+                    wait = self._last_update + self.coalesce - monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if not self._running:
+                    return
+                target, self._pending = self._pending, None
+            self._apply(target)
+
+    def _apply(self, target):
+        for channel, value in target.items():
+            if self._applied[channel] == value:
+                self.saved += 1
+                continue
+            if channel == SERVO:
+                self.px.set_dir_servo_angle(value)
+            else:
+                self.px.set_motor_speed(channel, value)
+            self._applied[channel] = value
+            self.writes += 1
+        self._last_update = monotonic()
@@ -0,0 +1,67 @@
+import threading
+from bisect import bisect_left
+from collections import deque
+from time import monotonic
+
+
+class Odometer:
+    # Integrates travelled distance at a fixed rate from rate_fn(), the
+    # current speed in cm/s as implied by direction and power. Time always
+    # comes from the monotonic clock, so the total cannot jump backwards.
+    # Call mark() right before direction or power change so the interval up
+    # to the change is integrated with the old speed, not the new one.
+
+    def __init__(self, rate_fn, hz=20.0, history_seconds=300):
+        self.rate_fn = rate_fn
+        self.hz = hz
+        self._lock = threading.Lock()
+        self._last = monotonic()
+        self._total = 0.0
+        self._snapshot = (0.0, self._last) # (total cm, monotonic time), swapped as a whole
+        self._history = deque(maxlen=int(hz * history_seconds) + 1) # (monotonic time, total cm)
+        self._history.append((self._last, 0.0))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="odometer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _run(self):
+        period = 1.0 / self.hz
+        while not self._stop.wait(period):
+            self.mark()
+
+    def mark(self):
+        with self._lock:
+            now = monotonic()
+            self._total += self.rate_fn() * (now - self._last)
+            self._last = now
+            self._snapshot = (self._total, now)
+            self._history.append((now, self._total))
+
+    def distance(self):
+        return self._snapshot[0]
+
+    def distance_over(self, seconds, until=0.0):
+        # distance covered between `seconds` and `until` seconds ago
+        now = monotonic()
+        return self._total_at(now - until) - self._total_at(now - seconds)
+
+    def _total_at(self, t):
+        with self._lock:
+            history = list(self._history)
+        i = bisect_left(history, (t,))
+        if i == 0:
+            return history[0][1]
+        if i == len(history):
+            return history[-1][1]
+        (t0, d0), (t1, d1) = history[i - 1], history[i]
+        return d0 + (d1 - d0) * (t - t0) / (t1 - t0)
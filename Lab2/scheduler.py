@@ -0,0 +1,127 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+from time import monotonic
+
+
+BUSY, EXPIRED, SUPERSEDED = 'busy', 'expired', 'superseded'
+
+
+class RequestScheduler:
+    # Bounded pool of worker threads in front of a request handler.
+    # Requests wait in a priority queue (lower number runs first, FIFO within a
+    # priority). A request still queued after its deadline is dropped, and
+    # when the queue is full the newest lowest-priority request is refused, so
+    # a motor command can always displace a queued telemetry read. With
+    # `replace`, a request whose key matches one still queued takes its place,
+    # and the older one is answered "superseded" without running.
+
+    def __init__(self, handler, workers=2, max_queue=16, priority=None, deadlines=None, replace=None):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.priority = priority or (lambda service: 0)
+        self.deadlines = deadlines or {} # priority -> default deadline in seconds
+        self.replace = replace or (lambda service: None) # service -> key, None never replaces
+        self.rejected = 0
+        self.expired = 0
+        self.superseded = 0
+        self._heap = []
+        self._queued = {} # replace key -> its entry in the heap
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._running = False
+
+    @staticmethod
+    def reply(status, service):
+        return {'error': status, 'service': service}
+
+    def start(self):
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"scheduler-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            pending, self._heap = self._heap, []
+            self._queued.clear()
+            self._cond.notify_all()
+        for entry in pending:
+            entry[4].set_result(self.reply(BUSY, entry[2]))
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+
+    def depth(self):
+        return len(self._heap)
+
+    def submit(self, service, timeout=None):
+        # returns a Future resolving to the handler's reply dict
+        future = Future()
+        prio = self.priority(service)
+        if timeout is None:
+            timeout = self.deadlines.get(prio)
+        deadline = monotonic() + timeout if timeout is not None else None
+        entry = (prio, next(self._seq), service, deadline, future)
+        key = self.replace(service)
+        refused = replaced = None
+        with self._cond:
+            if not self._running:
+                refused = entry
+            elif key is not None and key in self._queued:
+                replaced = self._queued[key]
+                self._heap.remove(replaced)
+                heapq.heapify(self._heap)
+            elif len(self._heap) >= self.max_queue:
+                worst = max(self._heap)
+                if worst[0] <= prio:
+                    refused = entry
+                else:
+                    self._heap.remove(worst)
+                    heapq.heapify(self._heap)
+                    self._forget(worst)
+                    refused = worst
+            if refused is not entry:
+                heapq.heappush(self._heap, entry)
+                if key is not None:
+                    self._queued[key] = entry
+                self._cond.notify()
+        if refused is not None:
+            self.rejected += 1
+            refused[4].set_result(self.reply(BUSY, refused[2]))
+        if replaced is not None:
+            self.superseded += 1
+            replaced[4].set_result(self.reply(SUPERSEDED, replaced[2]))
+        return future
+
+    def _forget(self, entry):
+        # call with the lock held, once entry has left the heap
+        key = self.replace(entry[2])
+        if key is not None and self._queued.get(key) is entry:
+            del self._queued[key]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._heap:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                entry = heapq.heappop(self._heap)
+                self._forget(entry)
+            _, _, service, deadline, future = entry
+            if not future.set_running_or_notify_cancel():
+                continue
+            if deadline is not None and monotonic() > deadline:
+                self.expired += 1
+                future.set_result(self.reply(EXPIRED, service))
+                continue
+            try:
+                future.set_result(self.handler(service))
+            except Exception as e:
+                future.set_exception(e)
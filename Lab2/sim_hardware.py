@@ -0,0 +1,190 @@
+import math
+import os
+import random
+import threading
+from time import monotonic, sleep
+
+from battery import ADC_MAX, ADC_VREF, DIVIDER
+from thermal import decode_throttled
+
+
+# Tunables of the simulated car; override any of them with
+# PICAR_SIM="ultrasonic_latency=0.03,ultrasonic_noise=1.5,seed=1"
+SIM_DEFAULTS = {
+    'ultrasonic_latency': 0.015,  # seconds per reading (echo round trip + driver)
+    'ultrasonic_noise': 0.5,      # cm, standard deviation
+    'ultrasonic_dropout': 0.01,   # fraction of readings that time out (-1)
+    'motor_latency': 0.0002,      # seconds per PWM/servo write
+    'i2c_latency': 0.0005,        # seconds per SMBus transaction
+    'adc_noise': 8,               # raw ADC counts, standard deviation
+    'thermal_latency': 0.0001,    # seconds per temperature read
+    'cm_per_power': 0.25,         # wheel speed in cm/s per unit of motor power
+    'left_gain': 1.67,            # motor 1 runs faster; move() scales it by 0.6 to go straight
+    'track': 12.0,                # cm between the rear wheels
+    'wheelbase': 10.0,            # cm between the axles
+    'wall': 300.0,                # cm from the start position to the wall ahead
+    'battery_voltage': 8.1,       # volts at start
+    'battery_drain': 0.0005,      # volts per second while the motors run
+    'seed': None,
+}
+ULTRASONIC_MIN, ULTRASONIC_MAX = 2.0, 400.0
+
+
+def sim_config(spec=None):
+    config = dict(SIM_DEFAULTS)
+    if spec is None:
+        spec = os.environ.get('PICAR_SIM', '')
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        key, _, value = item.partition('=')
+        if key not in config:
+            raise ValueError(f"Unknown simulator setting: {key}")
+        config[key] = float(value) if key != 'seed' else int(value)
+    return config
+
+
+class SimWorld:
+    # Kinematic model shared by the simulated devices. The car is a
+    # differential drive with a steered front axle. Its pose is advanced
+    # lazily, integrated up to now whenever a device touches it.
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config['seed'])
+        self.x = 0.0 # cm towards the wall
+        self.y = 0.0
+        self.heading = 0.0 # radians, 0 faces the wall
+        self.servo = 0.0 # degrees
+        self.motors = {1: 0.0, 2: 0.0}
+        self.voltage = config['battery_voltage']
+        self._last = monotonic()
+        self._lock = threading.Lock()
+
+    def _advance(self):
+        now = monotonic()
+        dt, self._last = now - self._last, now
+        # motor 2 is mounted mirrored: forward is (+p, -p), as in the servers' move()
+        left = self.motors[1] * self.config['cm_per_power'] * self.config['left_gain']
+        right = -self.motors[2] * self.config['cm_per_power']
+        v = (left + right) / 2
+        omega = (right - left) / self.config['track']
+        omega += v * math.tan(math.radians(-self.servo)) / self.config['wheelbase']
+        self.heading += omega * dt
+        self.x += v * math.cos(self.heading) * dt
+        self.y += v * math.sin(self.heading) * dt
+        if left or right:
+            self.voltage -= self.config['battery_drain'] * dt
+
+    def set_servo(self, angle):
+        with self._lock:
+            self._advance()
+            self.servo = angle
+
+    def set_motor(self, motor, speed):
+        with self._lock:
+            self._advance()
+            self.motors[motor] = speed
+
+    def range_to_wall(self):
+        with self._lock:
+            self._advance()
+            cos = math.cos(self.heading)
+            if cos <= 0.05:
+                return ULTRASONIC_MAX
+            return (self.config['wall'] - self.x) / cos
+
+    def battery_voltage(self):
+        with self._lock:
+            self._advance()
+            return self.voltage
+
+
+class SimUltrasonic:
+
+    def __init__(self, world):
+        self.world = world
+
+    def read(self):
+        config = self.world.config
+        sleep(config['ultrasonic_latency'])
+        if self.world.random.random() < config['ultrasonic_dropout']:
+            return -1
+        dist = self.world.range_to_wall() + self.world.random.gauss(0, config['ultrasonic_noise'])
+        return round(min(ULTRASONIC_MAX, max(ULTRASONIC_MIN, dist)), 2)
+
+
+class SimPicarx:
+    # The subset of picarx.Picarx the servers use
+
+    def __init__(self, world):
+        self.world = world
+        self.ultrasonic = SimUltrasonic(world)
+
+    def set_dir_servo_angle(self, angle):
+        sleep(self.world.config['motor_latency'])
+        self.world.set_servo(angle)
+
+    def set_motor_speed(self, motor, speed):
+        sleep(self.world.config['motor_latency'])
+        self.world.set_motor(motor, speed)
+
+    def stop(self):
+        self.set_motor_speed(1, 0)
+        self.set_motor_speed(2, 0)
+
+
+class SimSMBus:
+    # Answers the battery ADC channel from the simulated pack voltage
+
+    def __init__(self, world):
+        self.world = world
+        self._result = []
+
+    def write_word_data(self, addr, register, value):
+        # channel select: latch a conversion for the following byte reads
+        sleep(self.world.config['i2c_latency'])
+        raw = self.world.battery_voltage() / DIVIDER / ADC_VREF * ADC_MAX
+        raw = int(min(ADC_MAX, max(0, raw + self.world.random.gauss(0, self.world.config['adc_noise']))))
+        self._result = [raw >> 8, raw & 0xFF]
+
+    def read_byte(self, addr):
+        sleep(self.world.config['i2c_latency'])
+        return self._result.pop(0) if self._result else 0
+
+    def close(self):
+        pass
+
+
+class SimThermal:
+    # Same interface as the backends in thermal.py
+
+    name = 'sim'
+
+    def __init__(self, world):
+        self.world = world
+
+    def read_temperature(self):
+        sleep(self.world.config['thermal_latency'])
+        load = 4.0 if any(self.world.motors.values()) else 0.0
+        return round(48.0 + load + self.world.random.gauss(0, 0.3), 1)
+
+    def read_throttled(self):
+        return decode_throttled(0)
+
+    def close(self):
+        pass
+
+
+class SimCamera:
+    # Stands in for vilib.Vilib
+
+    @staticmethod
+    def camera_start(vflip=False, hflip=False):
+        pass
+
+    @staticmethod
+    def display(local=True, web=True):
+        pass
+
+    @staticmethod
+    def camera_close():
+        pass
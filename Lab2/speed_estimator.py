@@ -0,0 +1,99 @@
+import threading
+from collections import deque
+from statistics import median
+from time import time, monotonic
+
+import log
+
+
+class SpeedEstimator:
+    # Samples the ultrasonic sensor at `rate` Hz into a ring buffer and fits a
+    # least-squares line through the last `window` seconds of readings. The
+    # slope is the speed in cm/s (positive when moving away from the obstacle,
+    # like the old two-reading read_speed()). speed() just returns the latest
+    # fit, so callers never wait on the sensor.
+
+    def __init__(self, read_distance, rate=20.0, window=1.0, outlier_cm=30.0, on_update=None):
+        self.read_distance = read_distance
+        self.rate = rate
+        self.window = window
+        self.outlier_cm = outlier_cm # max jump from the recent median before a reading is dropped
+        self.on_update = on_update # called with (speed, timestamp) after every new estimate
+        self.rejected = 0
+        self._samples = deque()
+        self._recent = deque(maxlen=5) # last raw readings, rejected ones included
+        self._speed = 0.0
+        self._updated = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._samples = deque(maxlen=max(2, int(self.rate * self.window) + 1))
+        self._recent.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="speed-estimator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _run(self):
+        period = 1.0 / self.rate
+        while not self._stop.is_set():
+            started = monotonic()
+            try:
+                self.add_sample(started, self.read_distance())
+            except Exception as e:
+                log.error('ultrasonic_failed', error=e)
+            self._expire(monotonic())
+            self._stop.wait(max(0, period - (monotonic() - started)))
+
+    def add_sample(self, t, dist):
+        # the ultrasonic driver reports timeouts and errors as negative values
+        if dist is None or dist < 0:
+            self.rejected += 1
+            return
+        # Compare against recent raw readings, not only accepted ones: a lone
+        # spike is dropped, but once most recent readings agree on a new
+        # distance (obstacle moved, car turned) they are accepted and the
+        # fit starts over instead of spanning the jump.
+        self._recent.append(dist)
+        if len(self._recent) >= 3 and abs(dist - median(self._recent)) > self.outlier_cm:
+            self.rejected += 1
+            return
+        if self._samples and abs(dist - self._samples[-1][1]) > self.outlier_cm:
+            self._samples.clear()
+        self._samples.append((t, dist))
+        while self._samples and t - self._samples[0][0] > self.window:
+            self._samples.popleft()
+        self._speed = self._fit()
+        self._updated = time()
+        if self.on_update is not None:
+            self.on_update(self._speed, self._updated)
+
+    def _expire(self, now):
+        # no valid reading for a whole window: the old fit says nothing about
+        # the car now. Report 0 but keep updated() at the last real estimate.
+        if self._samples and now - self._samples[-1][0] > self.window:
+            self._samples.clear()
+            self._speed = 0.0
+
+    def _fit(self):
+        n = len(self._samples)
+        if n < 2:
+            return 0.0
+        mean_t = sum(t for t, _ in self._samples) / n
+        mean_d = sum(d for _, d in self._samples) / n
+        var_t = sum((t - mean_t) ** 2 for t, _ in self._samples)
+        if var_t == 0:
+            return 0.0
+        return sum((t - mean_t) * (d - mean_d) for t, d in self._samples) / var_t
+
+    def speed(self):
+        return self._speed
+
+    def updated(self):
+        return self._updated
@@ -0,0 +1,170 @@
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from time import time, monotonic
+
+import log
+
+
+# one published reading; replaced as a whole so readers never see a torn value
+Sample = namedtuple('Sample', ['value', 'timestamp'])
+
+
+class TelemetrySampler:
+    # Polls every registered sensor on its own thread and schedule, and keeps
+    # the latest reading of each in a shared snapshot. Request handlers answer
+    # from the snapshot instead of touching the hardware themselves.
+
+    def __init__(self, fanout_workers=4):
+        self._sensors = {}
+        self._snapshot = {}
+        self._stop = threading.Event()
+        self._threads = []
+        self._fanout = ThreadPoolExecutor(max_workers=fanout_workers, thread_name_prefix="fanout")
+
+    def add_sensor(self, name, read, interval=None, ttl=None):
+        # ttl: how old a sample may get before a request reads the sensor itself.
+        # With interval=None nothing is polled; the value arrives via publish().
+        if ttl is None:
+            ttl = 3 * (interval or 0) + 1
+        self._sensors[name] = (read, interval, ttl)
+
+    def start(self):
+        self._stop.clear()
+        for name, (_, interval, _) in self._sensors.items():
+            if interval is None:
+                continue
+            thread = threading.Thread(target=self._run, args=(name,), name=f"sampler-{name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+
+    def _run(self, name):
+        interval = self._sensors[name][1]
+        while not self._stop.is_set():
+            started = monotonic()
+            self.refresh(name)
+            self._stop.wait(max(0, interval - (monotonic() - started)))
+
+    def refresh(self, name):
+        read = self._sensors[name][0]
+        try:
+            value = read()
+        except Exception as e:
+            log.error('sample_failed', sensor=name, error=e)
+            return None
+        # a sensor that knows when its value was measured returns a Sample
+        sample = value if isinstance(value, Sample) else Sample(value, time())
+        self._snapshot[name] = sample
+        return sample
+
+    def publish(self, name, value, timestamp=None):
+        self._snapshot[name] = Sample(value, time() if timestamp is None else timestamp)
+
+    def get(self, name):
+        sample = self._snapshot.get(name)
+        if sample is None or time() - sample.timestamp > self._sensors[name][2]:
+            # nothing sampled yet, or the sampler fell behind: read through
+            sample = self.refresh(name)
+            if sample is None:
+                raise Exception(f"No sample available for [{name}]")
+        return sample
+
+    def snapshot(self):
+        return dict(self._snapshot)
+
+    def gather(self, fillers, timeouts, default_timeout=1.0):
+        # Run fillers ({field: fn(res)}) concurrently, each into its own dict,
+        # and merge what finished. A field that errors or misses its timeout
+        # is listed under 'errors'/'timeouts' instead of failing the reply.
+        started = monotonic()
+        futures = {}
+        for field, fill in fillers.items():
+            part = {}
+            futures[field] = (part, self._fanout.submit(fill, part))
+        res = {}
+        for field in sorted(futures, key=lambda f: timeouts.get(f, default_timeout)):
+            part, future = futures[field]
+            remaining = started + timeouts.get(field, default_timeout) - monotonic()
+            try:
+                future.result(timeout=max(0, remaining))
+            except TimeoutError:
+                res.setdefault('timeouts', []).append(field)
+                continue
+            except Exception as e:
+                res.setdefault('errors', {})[field] = str(e)
+                continue
+            for key, value in part.items():
+                if key == 'samples':
+                    res.setdefault('samples', {}).update(value)
+                else:
+                    res[key] = value
+        return res
+
+    def fill(self, res, key, name=None):
+        # put the cached value in res[key] and its timestamp/age in res['samples']
+        sample = self.get(name or key)
+        res[key] = sample.value
+        res.setdefault('samples', {})[key] = {
+            'ts': round(sample.timestamp, 3),
+            'age': round(max(0, time() - sample.timestamp), 3),
+        }
+        return sample.value
+
+
+class Subscription:
+    # Per-client push state: which fields to stream, how often, and what was
+    # last sent, so each push carries only the fields whose value changed.
+
+    def __init__(self, fields, rate):
+        self.fields = tuple(fields)
+        self.rate = rate
+        self.period = 1.0 / rate
+        self._last = {}
+
+    def delta(self, values):
+        changed = {k: v for k, v in values.items() if k not in self._last or self._last[k] != v}
+        self._last.update(changed)
+        return changed
+
+
+class AdaptiveSubscription(Subscription):
+    # Subscription whose rate follows a slow link. Any backlog (replies or
+    # commands still waiting) halves the rate; while nothing waits it climbs
+    # back to the requested rate in tenths. Pushes never use more than
+    # `share` of the measured send throughput, leaving the rest for replies.
+
+    def __init__(self, fields, rate, min_rate=1.0, share=0.5):
+        super().__init__(fields, rate)
+        self.target = rate
+        self.min_rate = min(min_rate, rate)
+        self.share = share
+        self.frame_bytes = None # average push size
+        self._bytes = 0.0 # decayed bytes sent and seconds spent sending them
+        self._busy = 0.0
+
+    def throughput(self):
+        # bytes per second while the link was busy, None before any slow send
+        return self._bytes / self._busy if self._busy > 0 else None
+
+    def sent(self, nbytes, seconds):
+        # one frame (push or reply) written to the link
+        self._bytes = self._bytes * 0.9 + nbytes
+        self._busy = self._busy * 0.9 + seconds
+
+    def pushed(self, nbytes):
+        self.frame_bytes = nbytes if self.frame_bytes is None else 0.8 * self.frame_bytes + 0.2 * nbytes
+
+    def adjust(self, backlog):
+        rate = self.rate / 2 if backlog else self.rate + self.target / 10
+        throughput = self.throughput()
+        if throughput and self.frame_bytes:
+            rate = min(rate, self.share * throughput / self.frame_bytes)
+        self.rate = max(self.min_rate, min(self.target, rate))
+        self.period = 1.0 / self.rate
+        return self.rate
@@ -0,0 +1,120 @@
+import os
+import re
+import glob
+import subprocess
+
+import log
+
+
+THERMAL_ZONES = '/sys/class/thermal/thermal_zone*'
+THROTTLED_PATH = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+# bits of the firmware throttle word (vcgencmd get_throttled)
+THROTTLE_FLAGS = {
+    0: 'under_voltage',
+    1: 'freq_capped',
+    2: 'throttled',
+    3: 'soft_temp_limit',
+    16: 'under_voltage_occurred',
+    17: 'freq_capped_occurred',
+    18: 'throttled_occurred',
+    19: 'soft_temp_limit_occurred',
+}
+
+
+def decode_throttled(value):
+    flags = {name: bool(value & (1 << bit)) for bit, name in THROTTLE_FLAGS.items()}
+    flags['raw'] = hex(value)
+    return flags
+
+
+def active_flags(flags):
+    # compact form for replies: just the names of the flags that are set
+    return [name for name in THROTTLE_FLAGS.values() if flags.get(name)]
+
+
+class SysfsThermal:
+    # Reads the CPU thermal zone through a file descriptor opened once and
+    # re-read with pread, so a reading is one syscall instead of a fork/exec.
+
+    name = 'sysfs'
+
+    def __init__(self, zone=None):
+        if zone is None:
+            zone = self.find_zone()
+        self.zone = zone
+        self._temp_fd = os.open(os.path.join(zone, 'temp'), os.O_RDONLY)
+        self._throttled_fd = os.open(THROTTLED_PATH, os.O_RDONLY) if os.path.exists(THROTTLED_PATH) else None
+
+    @staticmethod
+    def find_zone():
+        zones = sorted(glob.glob(THERMAL_ZONES))
+        for zone in zones:
+            try:
+                with open(os.path.join(zone, 'type')) as f:
+                    if 'cpu' in f.read():
+                        return zone
+            except OSError:
+                continue
+        if not zones:
+            raise OSError("No thermal zone found")
+        return zones[0]
+
+    def read_temperature(self):
+        # millidegrees Celsius
+        return round(int(os.pread(self._temp_fd, 16, 0)) / 1000, 1)
+
+    def read_throttled(self):
+        if self._throttled_fd is None:
+            return None
+        return decode_throttled(int(os.pread(self._throttled_fd, 16, 0), 16))
+
+    def close(self):
+        for fd in (self._temp_fd, self._throttled_fd):
+            if fd is not None:
+                os.close(fd)
+        self._temp_fd = self._throttled_fd = None
+
+
+class VcgencmdThermal:
+    # Fallback for systems without a usable thermal zone: one vcgencmd process per reading.
+
+    name = 'vcgencmd'
+
+    def _vcgencmd(self, *args):
+        result = subprocess.run(['vcgencmd', *args], capture_output=True, text=True, check=True)
+        if result.stderr:
+            raise Exception(result.stderr)
+        return result.stdout
+
+    def read_temperature(self):
+        stdout = self._vcgencmd('measure_temp')
+        match = re.search(r'\d+\.\d+', stdout)
+        if not match:
+            raise Exception(f"Temp reading is malformed: {stdout}")
+        return float(match.group())
+
+    def read_throttled(self):
+        stdout = self._vcgencmd('get_throttled')
+        match = re.search(r'0x[0-9a-fA-F]+', stdout)
+        if not match:
+            raise Exception(f"Throttle reading is malformed: {stdout}")
+        return decode_throttled(int(match.group(), 16))
+
+    def close(self):
+        pass
+
+
+BACKENDS = {
+    SysfsThermal.name: SysfsThermal,
+    VcgencmdThermal.name: VcgencmdThermal,
+}
+
+
+def open_backend(name='auto'):
+    if name != 'auto':
+        return BACKENDS[name]()
+    try:
+        return SysfsThermal()
+    except OSError as e:
+        log.warning('thermal_fallback', backend='vcgencmd', error=e)
+        return VcgencmdThermal()
@@ -0,0 +1,164 @@
+import select
+import socket
+import struct
+import threading
+from time import time
+
+import binary_protocol
+import log
+
+
+# Datagram: <seq:u32> <sent_at:f64 unix seconds> <command>
+# command is either a binary steering/power opcode (see binary_protocol.py)
+# or a text service such as "dir.f" / "power.30".
+HEADER = struct.Struct('<Id')
+SEQ_MOD = 1 << 32
+MAX_MISSING = 256 # recent gap sequences remembered, so a late arrival is not counted lost
+CONTROL_PREFIXES = ('dir', 'power')
+
+
+def pack_command(seq, command):
+    # client side: one datagram for a text service or binary opcode bytes
+    if isinstance(command, str):
+        command = command.encode('utf-8')
+    return HEADER.pack(seq % SEQ_MOD, time()) + command
+
+
+def seq_newer(seq, last):
+    # serial number arithmetic, so the counter may wrap
+    return 0 < (seq - last) % SEQ_MOD < SEQ_MOD // 2
+
+
+class UdpControl:
+    # Real-time steering over UDP. A lost datagram never holds up later ones:
+    # after each wake-up the socket is drained and only the newest command is
+    # applied; older, duplicated and too-late datagrams are dropped silently.
+    # Client clocks are not assumed to be synced: latency is measured
+    # relative to the smallest (receive - send) offset seen from that client.
+
+    def __init__(self, handler, host, port, max_age=0.25):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_age = max_age
+        self.received = 0
+        self.applied = 0
+        self.stale = 0 # duplicate, older than max_age, or out of order but not in a gap
+        self.lost = 0 # sequence gaps not filled in later
+        self.reordered = 0 # arrived late into a gap; not applied, no longer counted as lost
+        self.latency = None # smoothed relative one-way latency, seconds
+        self.jitter = 0.0
+        self._clients = {} # addr -> [last seq, min clock offset, missing seqs]
+        self._sock = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.setblocking(False)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="udp-control", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'applied': self.applied,
+            'stale': self.stale,
+            'reordered': self.reordered,
+            'lost': self.lost,
+            'loss': round(self.lost / (self.received + self.lost), 4) if self.received + self.lost else 0.0,
+            'latency_ms': round(self.latency * 1000, 2) if self.latency is not None else None,
+            'jitter_ms': round(self.jitter * 1000, 2),
+        }
+
+    def _run(self):
+        while self._running:
+            try:
+                if not select.select([self._sock], [], [], 0.5)[0]:
+                    continue
+                # drain everything that queued up, then act on the newest only
+                datagrams = []
+                while True:
+                    try:
+                        datagrams.append(self._sock.recvfrom(64))
+                    except BlockingIOError:
+                        break
+            except (OSError, ValueError):
+                break
+            newest = {}
+            for data, addr in datagrams:
+                command = self._accept(data, addr, time())
+                if command is not None:
+                    newest[addr] = command
+            for command in newest.values():
+                try:
+                    self.handler(command)
+                    self.applied += 1
+                except Exception as e:
+                    log.error('udp_command_failed', command=command, error=e)
+
+    def _accept(self, data, addr, now):
+        if len(data) <= HEADER.size:
+            return None
+        seq, sent_at = HEADER.unpack_from(data)
+        self.received += 1
+        client = self._clients.get(addr)
+        offset = now - sent_at
+        if client is None:
+            client = self._clients[addr] = [seq, offset, set()]
+        else:
+            missing = client[2]
+            if not seq_newer(seq, client[0]):
+                if seq in missing: # counted lost by the gap, arrived after all
+                    missing.discard(seq)
+                    self.lost -= 1
+                    self.reordered += 1
+                else:
+                    self.stale += 1
+                return None
+            gap = (seq - client[0]) % SEQ_MOD - 1
+            self.lost += gap
+            if len(missing) + gap > MAX_MISSING:
+                missing.clear() # too far behind to still arrive
+            if gap <= MAX_MISSING:
+                missing.update((client[0] + i) % SEQ_MOD for i in range(1, gap + 1))
+            client[0] = seq
+            client[1] = min(client[1], offset)
+        delay = offset - client[1]
+        if self.latency is None:
+            self.latency = delay
+        else:
+            self.jitter += (abs(delay - self.latency) - self.jitter) / 16
+            self.latency += (delay - self.latency) / 8
+        if delay > self.max_age:
+            self.stale += 1
+            return None
+        return self._command(data[HEADER.size:])
+
+    @staticmethod
+    def _command(payload):
+        if binary_protocol.is_binary(payload[0]):
+            try:
+                requests = binary_protocol.BinaryDecoder().feed(payload)
+            except ValueError:
+                return None
+            commands = [service for service, _ in requests if isinstance(service, str)]
+            return commands[-1] if commands else None
+        try:
+            service = payload.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            return None
+        # telemetry and everything else stays on the reliable TCP port
+        return service if service.startswith(CONTROL_PREFIXES) else None
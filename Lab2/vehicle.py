@@ -0,0 +1,87 @@
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic
+
+import log
+
+
+class VehicleState:
+    # One immutable reading of the car's driving state. The actor builds a new
+    # one for every change and swaps it in with a single assignment, so a
+    # reader always sees a direction and power that belong together.
+    __slots__ = ('direction', 'power', 'version', 'since')
+
+    def __init__(self, direction, power, version=0, since=None):
+        object.__setattr__(self, 'direction', direction)
+        object.__setattr__(self, 'power', power)
+        object.__setattr__(self, 'version', version) # number of changes applied
+        object.__setattr__(self, 'since', monotonic() if since is None else since)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("VehicleState is immutable")
+
+    def __repr__(self):
+        return f"VehicleState(direction={self.direction!r}, power={self.power!r}, version={self.version})"
+
+
+class Vehicle:
+    # Single writer for the driving state and the motor outputs. Request
+    # threads, the motion planner and calibration never touch either
+    # directly: they submit() a change, and the actor thread applies the
+    # changes one at a time, in order. Readers use `state` without a lock.
+
+    def __init__(self, direction, power, apply, before_change=None):
+        self.apply = apply # apply(direction, power) drives the motors
+        self.before_change = before_change # before_change(old, new), e.g. close the odometer interval
+        self.state = VehicleState(direction, power)
+        self._queue = queue.SimpleQueue()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="vehicle", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._running = False
+        self._queue.put(None)
+        self._thread.join(timeout=2)
+        self._thread = None
+
+    def submit(self, direction=None, power=None):
+        # None keeps the current value; with neither set the motors are
+        # just rewritten. Returns a Future resolving to the new VehicleState.
+        if not self._running:
+            raise RuntimeError("Vehicle is not running")
+        future = Future()
+        self._queue.put((direction, power, future))
+        return future
+
+    def change(self, direction=None, power=None):
+        # submit() and wait until the change is applied
+        return self.submit(direction, power).result()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            direction, power, future = item
+            old = self.state
+            new = VehicleState(old.direction if direction is None else direction,
+                               old.power if power is None else power,
+                               old.version + 1)
+            try:
+                if self.before_change is not None:
+                    self.before_change(old, new)
+                self.state = new
+                self.apply(new.direction, new.power)
+            except Exception as e:
+                log.error('vehicle_change_failed', direction=new.direction, power=new.power, error=e)
+                future.set_exception(e)
+                continue
+            future.set_result(new)
@@ -1,228 +1,437 @@
 import socket
 import threading
 import json
-from smbus import SMBus
-import subprocess
-import re
-from time import sleep, time
-from picarx import Picarx
-from vilib import Vilib
+import argparse
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import binary_protocol
+from calibration import calibrate, CALIBRATION_FILE, CAL_POWERS
+from framing import MAX_PENDING
+import car
+from car import FORWARD, BACKWARD, LEFT, RIGHT, STOP, SPEED_RATE, SPEED_WINDOW, QUEUE_SIZE, DEADLINES, metrics
+import log
+from scheduler import RequestScheduler
+from telemetry import Subscription
+from udp_control import UdpControl
 
 
 HOST = "192.168.11.11"
 PORT = 65432
-power = 10
-LEFT, RIGHT, FORWARD, BACKWARD, STOP = 'left', 'right', 'forward', 'backward', 'stop'
-curr_dir = STOP
+UDP_PORT = 65433 # optional real-time steering channel (--udp)
 KEY = 'service'
-camera_on = False
-curr_dir, curr_time, distance = STOP, time(), 0
-powerDistMap = { # cm/s
-    FORWARD: 0.3,
-    BACKWARD: 0.1,
-    LEFT: 0.15,
-    RIGHT: 0.13,
-}
-
-px = Picarx()
-power_lock, dir_lock = threading.Lock(), threading.Lock()
-
-
-def read_speed():
-    distance_1 = round(px.ultrasonic.read(), 2)
-    sleep(1)
-    distance_2 = round(px.ultrasonic.read(), 2)
-    diff_dist = distance_2-distance_1
-    print(f"speed in cm/s: {diff_dist}")
-    return round(diff_dist, 2)
-
-def read_temperature():
-    result = subprocess.run(['vcgencmd', 'measure_temp'], capture_output=True, text=True, check=True)
-    if result.stderr:
-        raise Exception(result.stderr)
-    print(f"Temperature stdout: {result.stdout}")
-    match = re.search(r'\d+\.\d+', result.stdout)
-    if not match:
-        raise Exception(f"Temp reading is malformed: {result.stdout}")
-    print(f"Temperature: {match.group()}")
-    return match.group()
-
-def voltage_to_percent(voltage):
-    if voltage >= 8.28:
-        return 100
-    elif voltage >= 8.0:
-        return 90
-    elif voltage >= 7.8:
-        return 75
-    elif voltage >= 7.5:
-        return 50
-    elif voltage >= 7.0:
-        return 25
-    elif voltage >= 6.6:
-        return 10
-    else:
-        return 0
-
-def read_battery_level():
-    bus = SMBus(1)
-    bus.write_word_data(0x14, 0x13, 0)
-    msb = bus.read_byte(0x14)
-    lsb = bus.read_byte(0x14)
-    raw_adc = (msb << 8) | lsb
-    
-    # convert to battery level
-    voltage = raw_adc * 3.3 / 4095 * 3  
-    # ADC resolution = 12 bits (0–4095)
-    #     https://ptelectronics.ru/wp-content/uploads/AT32F413RCT7.pdf page 20
-    # ADC reference voltage: Usually 3.3V
-    #     https://ptelectronics.ru/wp-content/uploads/AT32F413RCT7.pdf page 29
-    # resistor divider is likely 3:1
-    battery_percent = voltage_to_percent(voltage)
-    print(f"Raw ADC: {raw_adc}, Voltage: {voltage:.2f} V, Battery: {battery_percent}%")
-
-    return battery_percent
-
-def calculateDistance(curr_time):
-    end_time = time()
-    if curr_dir is None or curr_dir == STOP:
-        curr_time = end_time
-        return 0
-    dist = powerDistMap[curr_dir]*power*(end_time - curr_time)
-    curr_time = end_time
-    return dist
-
-def returnDistance(dist):
-    return round(dist, 2)
-
-def move(direction, power):
-    if direction == STOP:
-        px.stop()
-    else:
-        if direction == FORWARD:
-            px.set_dir_servo_angle(0)
-            px.set_motor_speed(1, power*0.6)
-            px.set_motor_speed(2, -power)
-        elif direction == BACKWARD:
-            px.set_dir_servo_angle(0)
-            px.set_motor_speed(1, -power)
-            px.set_motor_speed(2, power*1.6)
-        elif direction == LEFT:
-            px.set_dir_servo_angle(-30)
-            px.set_motor_speed(1, -power)
-            px.set_motor_speed(2, -power)
-        elif direction == RIGHT:
-            px.set_dir_servo_angle(30) 
-            px.set_motor_speed(1, power)
-            px.set_motor_speed(2, power)
+REQ_ID = 'id'
+RECV_SIZE = 1024
+MAX_INFLIGHT = 4 # concurrent requests per connection
+HW_WORKERS = 2 # scheduler threads running handle_client_event
+SUBSCRIBE, UNSUBSCRIBE = 'subscribe', 'unsubscribe'
+PLAN = 'plan'
+SUB_FIELDS = ('battery', 'temperature', 'speed', 'power', 'distance', 'dir')
+SUB_RATE, MAX_SUB_RATE = 5.0, 20.0 # pushes per second
+
 
 def handle_client_event(service):
     res = {}
-    global power
-    global power_lock
-    global curr_dir
-    global camera_on
-    global distance
-    global curr_time
+    if not isinstance(service, (str, list)):
+        # malformed request: still answer it so a pipelined client isn't left waiting on its id
+        metrics.count_error(service)
+        res['error'] = "service must be a string or a list of fields"
+        return res
     try:
-        print(f"service: {service}")
-        if service.startswith("dir"):
-            if '.' in service:
-                distance += calculateDistance(curr_time)
-                direction = service.split('.')[1]
-                print(f"direction: {direction}")
-                if direction in ['l', LEFT]:
-                    move(LEFT, power)
-                    with dir_lock:
-                        curr_dir = LEFT
-                elif direction in ['r', RIGHT]:
-                    move(RIGHT, power)
-                    with dir_lock:
-                        curr_dir = RIGHT
-                elif direction in ['f', FORWARD]:
-                    move(FORWARD, power)
-                    with dir_lock:
-                        curr_dir = FORWARD
-                elif direction in ['b', BACKWARD]:
-                    move(BACKWARD, power)
-                    with dir_lock:
-                        curr_dir = BACKWARD
-                elif direction in ['s', STOP]:
-                    move(STOP, power)
-                    with dir_lock:
-                        curr_dir = STOP
-            print(f"curr_dir: {curr_dir}")
-            res['dir'] = curr_dir
-            res['speed'] = read_speed()
-            res['power'] = power
-            res['distance'] = returnDistance(distance)
-        elif service in ["battery", "batt"]:
-            res['battery'] = read_battery_level()
-        elif service in ["temp", "temperature"]:
-            res['temperature'] = read_temperature()
-        elif service in ["speed"]:
-            res['speed'] = read_speed()
-            res['power'] = power
-        elif service.startswith("power"):
-            if '.' in service:
-                distance += calculateDistance(curr_time)
-                new_power = int(service.split('.')[1])
-                print(f"new_power: {new_power}")
-                with power_lock:
-                    power = new_power
-            res['speed'] = read_speed()
-            res['power'] = power
-            res['distance'] = returnDistance(distance)
-            move(curr_dir, power)
-            print(f"power updated: {power}")
-        elif service in ["dist", "distance"]:
-            res['distance'] = returnDistance(distance)
-        elif service == "all":
-            res['battery'] = read_battery_level()
-            res['temperature'] = read_temperature()
-            res['speed'] = read_speed()
-            res['power'] = power
-            res['distance'] = returnDistance(distance)
+        car.handle(service, res)
     except Exception as e:
-        print(f"Error occured while reading [{service}]: {str(e)}")
+        metrics.count_error(service)
+        log.error('service_failed', service=service, error=e)
+        res['error'] = str(e) # binary clients get an 0xC1 failed frame
+    return res
+
+handle_client_event = metrics.track(handle_client_event) # per-service counts and latency
+
+udp_control = None
+car.commands.register('udp', lambda res, _: res.update(udp=udp_control.stats() if udp_control is not None else None))
+scheduler = RequestScheduler(handle_client_event, HW_WORKERS, QUEUE_SIZE, car.service_priority, DEADLINES)
+metrics.add_gauge('scheduler_queue', scheduler.depth)
+metrics.add_gauge('scheduler_rejected', lambda: scheduler.rejected)
+metrics.add_gauge('scheduler_expired', lambda: scheduler.expired)
+
+def read_lines(client):
+    # newline-delimited framing: one JSON request per line
+    buf = b''
+    while True:
+        chunk = client.recv(RECV_SIZE)
+        if not chunk:
+            break
+        buf += chunk
+        *lines, buf = buf.split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield line
+        if len(buf) > MAX_PENDING:
+            # same cap as the Bluetooth framer; a request is never this long
+            raise ValueError(f"Request longer than {MAX_PENDING} bytes")
+    if buf.strip():
+        yield buf
 
+def parse_request(line):
+    try:
+        data = json.loads(line.decode('utf-8'))
+    except ValueError as e:
+        log.warning('malformed_request', line=line, error=e)
+        return None
+    if not isinstance(data, dict) or KEY not in data:
+        return None
+    return data
+
+def request_timeout(data):
+    # optional per-request deadline in seconds
+    timeout = data.get('timeout')
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float))):
+        raise ValueError(f"timeout must be a number of seconds, not {timeout!r}")
+    return timeout
+
+def error_reply(data, e):
+    # a request that could not be run still gets an answer, with its id
+    res = {'error': str(e)}
+    if REQ_ID in data:
+        res[REQ_ID] = data[REQ_ID]
     return res
 
+def encode_reply(res):
+    return json.dumps(res).encode('utf-8') + b'\n'
+
+def send_reply(client, send_lock, res):
+    log.debug('reply', reply=res)
+    with send_lock:
+        client.sendall(encode_reply(res))
+
+sub_ids = itertools.count(1)
+
+def open_subscription(data):
+    fields = data.get('fields') or SUB_FIELDS
+    if isinstance(fields, str):
+        fields = [fields]
+    unknown = [f for f in fields if f not in SUB_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown subscription fields: {unknown}")
+    rate = float(data.get('rate', SUB_RATE))
+    if rate <= 0:
+        raise ValueError(f"Subscription rate must be positive: {rate}")
+    return Subscription(fields, min(rate, MAX_SUB_RATE))
+
+def update_subscriptions(data, subs):
+    # subs maps subscription id -> cancel callable for this connection.
+    # Returns the reply, plus (sub_id, Subscription) when a new stream should start.
+    res, new = {}, None
+    try:
+        if data[KEY] == SUBSCRIBE:
+            sub = open_subscription(data)
+            sub_id = data.get(REQ_ID, next(sub_ids))
+            cancel = subs.pop(sub_id, None)
+            if cancel is not None:
+                cancel()
+            res.update(sub=sub_id, fields=list(sub.fields), rate=sub.rate)
+            new = (sub_id, sub)
+        else:
+            targets = [data['sub']] if 'sub' in data else list(subs)
+            res['unsubscribed'] = []
+            for sub_id in targets:
+                cancel = subs.pop(sub_id, None)
+                if cancel is not None:
+                    cancel()
+                    res['unsubscribed'].append(sub_id)
+    except (ValueError, TypeError) as e:
+        res['error'] = str(e)
+    if REQ_ID in data:
+        res[REQ_ID] = data[REQ_ID]
+    return res, new
+
+def push_frame(sub_id, delta):
+    delta['sub'] = sub_id
+    return encode_reply(delta)
+
+def stream_subscription(client, send_lock, sub_id, sub, stop):
+    while not stop.wait(sub.period):
+        delta = sub.delta(car.telemetry_values(sub.fields))
+        if not delta:
+            continue
+        try:
+            with send_lock:
+                client.sendall(push_frame(sub_id, delta))
+        except OSError:
+            break
+
+def handle_subscription(client, send_lock, subs, data):
+    res, new = update_subscriptions(data, subs)
+    send_reply(client, send_lock, res)
+    if new is not None:
+        sub_id, sub = new
+        stop = threading.Event()
+        subs[sub_id] = stop.set
+        threading.Thread(target=stream_subscription, args=(client, send_lock, sub_id, sub, stop), daemon=True).start()
+
+def plan_request(data):
+    # {"service": "plan", "segments": [...]} starts a plan right away, no scheduler hop
+    res = car.start_plan(data.get('segments'))
+    if REQ_ID in data:
+        res[REQ_ID] = data[REQ_ID]
+    return res
+
+def handle_request(client, send_lock, data):
+    try:
+        log.debug('request', service=data[KEY])
+        res = scheduler.submit(data[KEY], request_timeout(data)).result()
+        if REQ_ID in data:
+            res[REQ_ID] = data[REQ_ID]
+        send_reply(client, send_lock, res)
+    except Exception as e:
+        log.error('request_failed', error=e)
+        try:
+            send_reply(client, send_lock, error_reply(data, e))
+        except OSError:
+            pass
+
+def handle_binary_client(client):
+    # binary clients are served strictly in order, one reply frame per request
+    decoder = binary_protocol.BinaryDecoder()
+    while True:
+        chunk = client.recv(RECV_SIZE)
+        if not chunk:
+            break
+        for service, mask in decoder.feed(chunk):
+            res = scheduler.submit(service).result()
+            client.sendall(binary_protocol.encode_reply(res, mask))
+
 def handle_client(client):
-    with client:
+    # The connection stays open until the client closes it. Requests that carry
+    # an id are pipelined: they run concurrently and their replies echo the id,
+    # so they may come back out of order. Requests without an id are handled
+    # in order, which keeps the old one-request-per-connection clients working.
+    # Subscriptions push changed telemetry on the same connection until
+    # unsubscribed or the client goes away. A client whose first byte is
+    # >= 0x80 speaks the binary protocol instead (see binary_protocol.py).
+    send_lock = threading.Lock()
+    subs = {}
+    with client, ThreadPoolExecutor(max_workers=MAX_INFLIGHT) as pool:
         try:
-            data = json.loads(client.recv(1024).decode('utf-8'))
-            if not data or KEY not in data:
+            head = client.recv(1, socket.MSG_PEEK)
+            if head and binary_protocol.is_binary(head[0]):
+                handle_binary_client(client)
                 return
-            print(f"** data: {data[KEY]}")
-            res = handle_client_event(data[KEY])
+            for line in read_lines(client):
+                data = parse_request(line)
+                if data is None:
+                    continue
+                if data[KEY] in (SUBSCRIBE, UNSUBSCRIBE):
+                    handle_subscription(client, send_lock, subs, data)
+                elif data[KEY] == PLAN and 'segments' in data:
+                    send_reply(client, send_lock, plan_request(data))
+                elif REQ_ID in data:
+                    pool.submit(handle_request, client, send_lock, data)
+                else:
+                    handle_request(client, send_lock, data)
+        except (OSError, ValueError) as e:
+            log.warning('client_error', error=e)
+        finally:
+            for cancel in subs.values():
+                cancel()
+
 
-            # test json
-            # data = {'battery': 76, 'temp': 45}
-            print(res)
-            client.sendall(json.dumps(res).encode('utf-8') + b'\n')
+async def handle_binary_client_async(reader, writer, chunk):
+    decoder = binary_protocol.BinaryDecoder()
+    while chunk:
+        for service, mask in decoder.feed(chunk):
+            res = await asyncio.wrap_future(scheduler.submit(service))
+            writer.write(binary_protocol.encode_reply(res, mask))
+        await writer.drain()
+        chunk = await reader.read(RECV_SIZE)
+
+async def handle_client_async(reader, writer):
+    # Same protocol as handle_client, but on the event loop. The blocking
+    # hardware work in handle_client_event runs on the scheduler's workers.
+    write_lock = asyncio.Lock()
+    tasks = set()
+    subs = {}
+
+    async def respond(data):
+        try:
+            log.debug('request', service=data[KEY])
+            res = await asyncio.wrap_future(scheduler.submit(data[KEY], request_timeout(data)))
+            if REQ_ID in data:
+                res[REQ_ID] = data[REQ_ID]
+            log.debug('reply', reply=res)
+            async with write_lock:
+                writer.write(encode_reply(res))
+                await writer.drain()
         except Exception as e:
-            print(f"Error occured while handling client event: {str(e)}")
+            log.error('request_failed', error=e)
+            try:
+                async with write_lock:
+                    writer.write(encode_reply(error_reply(data, e)))
+                    await writer.drain()
+            except OSError:
+                pass
 
+    async def stream(sub_id, sub):
+        try:
+            while True:
+                await asyncio.sleep(sub.period)
+                delta = sub.delta(car.telemetry_values(sub.fields))
+                if delta:
+                    async with write_lock:
+                        writer.write(push_frame(sub_id, delta))
+                        await writer.drain()
+        except OSError:
+            pass
 
-def main():
-    Vilib.camera_start(vflip=False,hflip=False)
-    Vilib.display(local=True,web=True)
+    async def subscription(data):
+        res, new = update_subscriptions(data, subs)
+        log.debug('reply', reply=res)
+        async with write_lock:
+            writer.write(encode_reply(res))
+            await writer.drain()
+        if new is not None:
+            subs[new[0]] = asyncio.create_task(stream(*new)).cancel
+
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    log.info('connected', peer=writer.get_extra_info('peername'))
+    try:
+        head = await reader.read(1)
+        if head and binary_protocol.is_binary(head[0]):
+            await handle_binary_client_async(reader, writer, head)
+            return
+        while True:
+            line = head + await reader.readline() if head else await reader.readline()
+            head = b''
+            if not line:
+                break
+            if not line.strip():
+                continue
+            data = parse_request(line)
+            if data is None:
+                continue
+            if data[KEY] in (SUBSCRIBE, UNSUBSCRIBE):
+                await subscription(data)
+            elif data[KEY] == PLAN and 'segments' in data:
+                async with write_lock:
+                    writer.write(encode_reply(plan_request(data)))
+                    await writer.drain()
+            elif REQ_ID in data:
+                task = asyncio.create_task(respond(data))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            else:
+                await respond(data)
+        if tasks:
+            await asyncio.gather(*tasks)
+    except (OSError, ValueError) as e:
+        log.warning('client_error', error=e)
+    finally:
+        for cancel in subs.values():
+            cancel()
+        writer.close()
+
+async def serve_async(host, port):
+    server = await asyncio.start_server(handle_client_async, host, port, reuse_address=True, limit=MAX_PENDING)
+    async with server:
+        await server.serve_forever()
+
+def serve_threads(host, port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, PORT))
+        s.bind((host, port))
         s.listen()
         try:
             while True:
                 client, addr = s.accept()
-                print("server recv from: ", addr)
+                log.info('connected', peer=addr)
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 thread = threading.Thread(target=handle_client, args=(client,))
                 thread.start()
-        except KeyboardInterrupt:
-            print("Shutting down")
-        finally: 
-            print("Closing socket")
+        finally:
+            log.info('closing_socket')
             s.close()
-            Vilib.camera_close()
+
+def run_calibration(powers):
+    car.motors.start()
+    car.vehicle.start()
+    try:
+        car.speed_model = calibrate(car.drive, car.px.ultrasonic.read, [FORWARD, BACKWARD, LEFT, RIGHT], STOP, powers)
+    finally:
+        car.vehicle.close()
+        car.motors.close()
+    car.speed_model.save()
+    print(f"Calibration saved to {CALIBRATION_FILE}")
+
+def add_arguments(parser):
+    # Wi-Fi front-end options, shared with car_daemon.py
+    parser.add_argument('--host', default=HOST, help="address to listen on")
+    parser.add_argument('--port', type=int, default=PORT, help="TCP port; UDP steering uses the next one")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help="thread per connection, or a single asyncio event loop")
+    parser.add_argument('--workers', type=int, default=HW_WORKERS,
+                        help="worker threads running requests against the car")
+    parser.add_argument('--queue', type=int, default=QUEUE_SIZE,
+                        help="queued requests before the server answers busy")
+    parser.add_argument('--udp', action='store_true',
+                        help=f"also accept steering datagrams on UDP port {UDP_PORT}")
+    parser.add_argument('--speed-rate', type=float, default=SPEED_RATE,
+                        help="ultrasonic samples per second for the speed estimate")
+    parser.add_argument('--speed-window', type=float, default=SPEED_WINDOW,
+                        help="seconds of ultrasonic history the speed estimate is fitted over")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics over HTTP on this port")
+
+def start(args):
+    # the request scheduler and optional UDP channel; call after car.start()
+    global udp_control
+    scheduler.workers, scheduler.max_queue = args.workers, args.queue
+    scheduler.start()
+    if args.udp:
+        udp_control = UdpControl(handle_client_event, args.host, args.port + 1)
+        udp_control.start()
+
+def serve(args):
+    # blocks until interrupted
+    if args.engine == 'asyncio':
+        asyncio.run(serve_async(args.host, args.port))
+    else:
+        serve_threads(args.host, args.port)
+
+def stop():
+    if udp_control is not None:
+        udp_control.stop()
+    scheduler.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="PiCar-X Wi-Fi control server")
+    add_arguments(parser)
+    parser.add_argument('--calibrate', action='store_true',
+                        help="drive each direction in front of a wall, save the speed model to calibration.json and exit")
+    parser.add_argument('--cal-powers', type=int, nargs='+', default=list(CAL_POWERS),
+                        help="power levels driven during calibration")
+    args = parser.parse_args()
+    if args.calibrate:
+        run_calibration(args.cal_powers)
+        return
+    car.speed_estimator.rate, car.speed_estimator.window = args.speed_rate, args.speed_window
+
+    car.hw.camera.camera_start(vflip=False,hflip=False)
+    car.hw.camera.display(local=True,web=True)
+    car.start()
+    start(args)
+    if args.metrics_port:
+        metrics.serve_http(args.host, args.metrics_port)
+    try:
+        serve(args)
+    except KeyboardInterrupt:
+        log.info('shutting_down')
+    finally:
+        metrics.stop_http()
+        stop()
+        car.stop()
+    car.hw.camera.camera_close()
 
 if __name__ == "__main__":
     main()